@@ -0,0 +1,161 @@
+import hashlib
+import json
+import tempfile
+from dataclasses import dataclass
+from decimal import Decimal
+from pathlib import Path
+from typing import Optional
+
+from backend.audio_buffer import SampleBuffer, mix, write_wav
+from backend.common import CACHE_DIR, atomic_write
+from backend.profiling import profiler
+from backend.schemas import Clause
+
+ALIGNMENT_CACHE_DIR = CACHE_DIR / "alignment"
+ALIGNMENT_CONFIG = u"task_language=eng|is_text_type=plain|os_task_file_format=json"
+
+
+@dataclass
+class AlignedFragment:
+    """The span of one line of a transcript, in seconds from the start of its clause.
+
+    Mirrors the attributes `process_fragments` reads from aeneas' `SyncMapFragment`, but
+    is cheap to pickle and cache.  Times are kept as Decimals like aeneas' `TimeValue`
+    so millisecond conversions round the same way.
+    """
+    begin: Decimal
+    end: Decimal
+    text: str
+    is_head_or_tail: bool = False
+    # The line's index in its clause, which identifies it even when the text is repeated
+    index: Optional[int] = None
+
+
+class AlignmentCache:
+    """Alignments stored on disk, one JSON file per clause keyed on its audio and transcript.
+
+    A clause aligned in a batch is aligned against its neighbours' audio too, so its
+    entry is keyed on the whole batch with `batch_keys` rather than the clause alone.
+
+    :param cache_dir: The directory holding the cached alignments.
+    """
+    def __init__(self, cache_dir: Path=ALIGNMENT_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(audio: SampleBuffer, transcript: str) -> str:
+        digest = hashlib.sha256(audio.samples.tobytes())
+        digest.update(f"{audio.sample_rate}:{audio.channels}:{transcript}".encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def batch_keys(keys: list[str]) -> list[str]:
+        """The keys of clauses aligned together, each covering the clause and the batch it's in."""
+        batch = hashlib.sha256("".join(keys).encode("utf-8")).hexdigest()
+        return [hashlib.sha256(f"{batch}:{ix}:{key}".encode("utf-8")).hexdigest() for ix, key in enumerate(keys)]
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[list[AlignedFragment]]:
+        path = self.path(key)
+        if not path.exists():
+            return None
+        with open(path, "r") as cache_file:
+            return [
+                AlignedFragment(Decimal(f["begin"]), Decimal(f["end"]), f["text"], f["is_head_or_tail"], f.get("index"))
+                for f in json.load(cache_file)
+            ]
+
+    def put(self, key: str, fragments: list[AlignedFragment]):
+        data = [
+            {"begin": str(f.begin), "end": str(f.end), "text": f.text, "is_head_or_tail": f.is_head_or_tail, "index": f.index}
+            for f in fragments
+        ]
+        atomic_write(self.path(key), json.dumps(data).encode("utf-8"))
+
+
+def align_batch(clauses: list[tuple[SampleBuffer, Clause]]) -> list[list[AlignedFragment]]:
+    """Align many clauses with a single aeneas run.
+
+    The clause audio is joined into one file and the transcripts into one text, so the
+    MFCC extraction and DTW setup happen once for the whole batch.  The resulting sync
+    map is then split back up by each clause's line count, shifted to clause time and
+    clipped to the clause, whose silence before the first and after the last line is
+    marked as its head and tail like a single clause run would.
+    """
+    from aeneas.executetask import ExecuteTask # type: ignore
+    from aeneas.task import Task # type: ignore
+
+    audio = mix([buffer for buffer, _ in clauses])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_path = Path(tmp_dir, "batch.wav")
+        transcript_path = Path(tmp_dir, "batch.txt")
+        write_wav(audio_path, audio)
+        transcript_path.write_text("\n".join(clause.text for _, clause in clauses))
+
+        task = Task(config_string=ALIGNMENT_CONFIG)
+        task.audio_file_path_absolute = str(audio_path.absolute())
+        task.text_file_path_absolute = str(transcript_path.absolute())
+        ExecuteTask(task).execute()
+        leaves = iter([leaf for leaf in task.sync_map_leaves() if not leaf.is_head_or_tail])
+
+    alignments = []
+    offset_samples = 0
+    for buffer, clause in clauses:
+        offset = Decimal(offset_samples) / Decimal(buffer.sample_rate)
+        duration = Decimal(buffer.frame_count) / Decimal(buffer.sample_rate)
+        def clip(time) -> Decimal:
+            return min(duration, max(Decimal(0), Decimal(time) - offset))
+
+        alignment = []
+        for fragment_ix in range(len(clause.fragments)):
+            leaf = next(leaves)
+            alignment.append(AlignedFragment(
+                begin=clip(leaf.begin),
+                end=clip(leaf.end),
+                text=leaf.text,
+                index=fragment_ix,
+            ))
+        head_end = alignment[0].begin if alignment else duration
+        tail_begin = alignment[-1].end if alignment else duration
+        alignments.append([
+            AlignedFragment(Decimal(0), head_end, "", is_head_or_tail=True),
+            *alignment,
+            AlignedFragment(tail_begin, duration, "", is_head_or_tail=True),
+        ])
+        offset_samples += buffer.frame_count
+    return alignments
+
+def align_clauses(
+    clauses: list[tuple[SampleBuffer, Clause]], 
+    cache_dir: Path=ALIGNMENT_CACHE_DIR,
+) -> list[list[AlignedFragment]]:
+    """Align every clause in one aeneas run, unless the alignments of the batch are cached.
+
+    A clause's alignment depends on the rest of the batch it's aligned with, so when any
+    clause is missing from the cache the whole batch is aligned again, keeping every
+    cached alignment the result of aligning exactly the batch in its key.
+
+    :param clauses: The decoded audio of each clause along with the clause it speaks.
+    :param cache_dir: Where alignments are cached, keyed on the audio and transcripts of the batch.
+
+    :return: The alignment of each clause, in the order of `clauses`.
+    """
+    with profiler.stage("align", clauses=len(clauses)):
+        cache = AlignmentCache(cache_dir)
+        keys = AlignmentCache.batch_keys([AlignmentCache.key(buffer, clause.text) for buffer, clause in clauses])
+        alignments = [cache.get(key) for key in keys]
+        missing = [ix for ix, alignment in enumerate(alignments) if alignment is None]
+        if missing:
+            alignments = align_batch(clauses)
+            for key, alignment in zip(keys, alignments):
+                cache.put(key, alignment)
+        profiler.count(
+            "align",
+            bytes=sum(buffer.samples.nbytes for buffer, _ in clauses),
+            cache_hits=0 if missing else len(clauses),
+            cache_misses=len(clauses) if missing else 0,
+        )
+    return alignments  # type: ignore
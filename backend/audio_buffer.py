@@ -0,0 +1,240 @@
+import wave
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+from pydub import AudioSegment # type: ignore
+
+from backend.common import atomic_write
+
+INT16_SCALE = float(1 << 15)
+
+
+@dataclass
+class SampleBuffer:
+    """PCM audio stored as an int16 array of shape (samples, channels).
+
+    Slicing by milliseconds returns a view into the same array, and `padding` counts
+    trailing samples of silence that are implied rather than stored, so a fragment and
+    its padded copy never duplicate the clause they were cut from.  Convert to an
+    AudioSegment with `to_segment` only where pydub is actually needed.
+    """
+    samples: npt.NDArray[np.int16]
+    sample_rate: int
+    padding: int = field(default=0)
+
+    @classmethod
+    def from_segment(cls, segment: AudioSegment) -> "SampleBuffer":
+        segment = segment.set_sample_width(2)
+        samples = np.frombuffer(bytearray(segment.raw_data), dtype=np.int16)
+        return cls(samples.reshape(-1, segment.channels), segment.frame_rate)
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "SampleBuffer":
+        return cls.from_segment(AudioSegment.from_file(path))
+
+    @classmethod
+    def from_float(cls, samples: npt.NDArray[np.float32], sample_rate: int) -> "SampleBuffer":
+        """Create a buffer from float samples of shape (channels, samples) in [-1, 1]."""
+        pcm = np.clip(samples.T * INT16_SCALE, -INT16_SCALE, INT16_SCALE - 1).astype(np.int16)
+        return cls(pcm, sample_rate)
+
+    @classmethod
+    def silent(cls, duration_ms: float, sample_rate: int, channels: int=1) -> "SampleBuffer":
+        return cls(np.zeros((0, channels), dtype=np.int16), sample_rate).padded(duration_ms)
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def frame_count(self) -> int:
+        return self.samples.shape[0] + self.padding
+
+    @property
+    def dBFS(self) -> float:
+        if not self.samples.size:
+            return -float("inf")
+        rms = np.sqrt(np.mean(np.square(self.samples, dtype=np.float64)))
+        return 20 * np.log10(rms / INT16_SCALE) if rms else -float("inf")
+
+    def __len__(self) -> int:
+        """The duration in milliseconds, matching `len(AudioSegment)`."""
+        return round(1000 * self.frame_count / self.sample_rate)
+
+    def __getitem__(self, ms: slice) -> "SampleBuffer":
+        start = 0 if ms.start is None else self.ms_to_samples(ms.start)
+        end = self.samples.shape[0] if ms.stop is None else self.ms_to_samples(ms.stop)
+        return SampleBuffer(self.samples[max(0, start):max(0, end)], self.sample_rate)
+
+    def ms_to_samples(self, ms: float) -> int:
+        return int(ms * self.sample_rate / 1000)
+
+    def padded(self, duration_ms: float) -> "SampleBuffer":
+        """Return a view of this buffer followed by `duration_ms` of silence."""
+        return SampleBuffer(self.samples, self.sample_rate, self.padding + self.ms_to_samples(duration_ms))
+
+    def to_float(self) -> npt.NDArray[np.float32]:
+        """The stored samples as float32 of shape (channels, samples) in [-1, 1]."""
+        return self.samples.T.astype(np.float32) / INT16_SCALE
+
+    def to_pcm(self) -> npt.NDArray[np.int16]:
+        """The samples with any padding materialized."""
+        if not self.padding:
+            return self.samples
+        return np.concatenate([self.samples, np.zeros((self.padding, self.channels), dtype=np.int16)])
+
+    def to_segment(self) -> AudioSegment:
+        return AudioSegment(
+            self.to_pcm().tobytes(),
+            frame_rate=self.sample_rate,
+            sample_width=2,
+            channels=self.channels
+        )
+
+    def export(self, path: Union[str, Path]):
+        write_wav(path, self)
+
+
+def mix(buffers: list[SampleBuffer]) -> Optional[SampleBuffer]:
+    """Concatenate `buffers` into a single array allocated once at its final length."""
+    if not buffers:
+        return None
+    first = buffers[0]
+    output = np.zeros((sum(b.frame_count for b in buffers), first.channels), dtype=np.int16)
+    offset = 0
+    for buffer in buffers:
+        # Padding is left as the zeros the output was allocated with
+        output[offset:offset + buffer.samples.shape[0]] = buffer.samples
+        offset += buffer.frame_count
+    return SampleBuffer(output, first.sample_rate)
+
+def write_wav(path: Union[str, Path], buffer: SampleBuffer):
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(buffer.channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(buffer.sample_rate)
+        wav_file.writeframes(buffer.to_pcm().tobytes())
+
+
+def segment_to_samples(segment: AudioSegment) -> npt.NDArray[np.float32]:
+    """Convert an AudioSegment into a float32 array of shape (channels, samples) in [-1, 1]."""
+    samples = np.array(segment.get_array_of_samples(), dtype=np.float32)
+    samples = samples.reshape(-1, segment.channels).T
+    return samples / float(1 << (8 * segment.sample_width - 1))
+
+def samples_to_segment(samples: npt.NDArray[np.float32], sample_rate: int, sample_width: int=2) -> AudioSegment:
+    """Convert a float32 array of shape (channels, samples) back into an AudioSegment."""
+    scale = float(1 << (8 * sample_width - 1))
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sample_width]
+    pcm = np.clip(samples * scale, -scale, scale - 1).astype(dtype)
+    return AudioSegment(
+        pcm.T.tobytes(),
+        frame_rate=sample_rate,
+        sample_width=sample_width,
+        channels=samples.shape[0]
+    )
+
+
+class StreamingWavWriter:
+    """Appends buffers to a WAV file as they're rendered instead of mixing the whole session first.
+
+    The WAV header is written with a placeholder length and patched when the writer is
+    closed, so only the buffer currently being written is ever held in memory.  With
+    `segment_dir`, the audio is also split into numbered `segment_seconds` long WAV files
+    listed in an HLS-style `playlist.m3u8` that's updated as each segment completes, so
+    playback can start before rendering finishes.
+
+    :param path: The WAV file to write.
+    :param segment_dir: Where to write the segments and playlist, if at all.
+    :param segment_seconds: The length of each segment.
+    """
+    # Padding is written as zeros in blocks of this many samples
+    silence_block = 1 << 16
+
+    def __init__(self, path: Union[str, Path], segment_dir: Optional[Path]=None, segment_seconds: int=10):
+        self.path = Path(path)
+        self.segment_dir = segment_dir
+        self.segment_seconds = segment_seconds
+        self.wav_file: Optional[wave.Wave_write] = None
+        self.segment_file: Optional[wave.Wave_write] = None
+        self.segment_durations: list[float] = []
+        self.segment_frames = 0
+        self.sample_rate = 0
+        self.channels = 0
+        self.frames_written = 0
+
+    def __enter__(self) -> "StreamingWavWriter":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, buffer: SampleBuffer):
+        if self.wav_file is None:
+            self.sample_rate, self.channels = buffer.sample_rate, buffer.channels
+            self.wav_file = self._open(self.path)
+            if self.segment_dir:
+                self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self._write_frames(buffer.samples)
+        for start in range(0, buffer.padding, self.silence_block):
+            self._write_frames(np.zeros((min(self.silence_block, buffer.padding - start), self.channels), dtype=np.int16))
+
+    def close(self):
+        if self.wav_file:
+            self.wav_file.close()
+            self.wav_file = None
+        if self.segment_file:
+            self._finish_segment()
+        if self.segment_dir and self.segment_durations:
+            self._write_playlist(ended=True)
+
+    def _open(self, path: Path) -> wave.Wave_write:
+        wav_file = wave.open(str(path), "wb")
+        wav_file.setnchannels(self.channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(self.sample_rate)
+        return wav_file
+
+    def _write_frames(self, samples: npt.NDArray[np.int16]):
+        assert self.wav_file
+        # writeframesraw leaves the header alone, it's patched with the real length on close
+        self.wav_file.writeframesraw(samples.tobytes())
+        self.frames_written += samples.shape[0]
+        if not self.segment_dir:
+            return
+        segment_length = self.segment_seconds * self.sample_rate
+        while samples.shape[0]:
+            if self.segment_file is None:
+                self.segment_file = self._open(self.segment_dir / f"segment_{len(self.segment_durations):05d}.wav")
+            take = min(samples.shape[0], segment_length - self.segment_frames)
+            self.segment_file.writeframesraw(samples[:take].tobytes())
+            self.segment_frames += take
+            samples = samples[take:]
+            if self.segment_frames == segment_length:
+                self._finish_segment()
+
+    def _finish_segment(self):
+        assert self.segment_file
+        self.segment_file.close()
+        self.segment_file = None
+        self.segment_durations.append(self.segment_frames / self.sample_rate)
+        self.segment_frames = 0
+        self._write_playlist(ended=False)
+
+    def _write_playlist(self, ended: bool):
+        assert self.segment_dir
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{self.segment_seconds}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+        ]
+        for ix, duration in enumerate(self.segment_durations):
+            lines += [f"#EXTINF:{duration:.3f},", f"segment_{ix:05d}.wav"]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        atomic_write(self.segment_dir / "playlist.m3u8", ("\n".join(lines) + "\n").encode("utf-8"))
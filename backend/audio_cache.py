@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+from backend.common import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class AudioCache:
+    """Content-addressed store for TTS responses.
+
+    Entries are keyed on a hash of everything that determines the generated audio, so
+    edits or reorders in a script only miss for the clauses whose text actually changed.
+    An index file tracks entry sizes in least-recently-used order and the oldest entries
+    are evicted once the cache grows past `max_bytes`.  Entries returned by `get` or
+    `put` aren't evicted until they're materialized, so concurrent inserts can't remove
+    them in between.
+
+    :param cache_dir: The directory holding the cached audio and the index file.
+    :param max_bytes: The size the cache is trimmed back to after each insert.
+    """
+    index_name = "index.json"
+
+    def __init__(self, cache_dir: Path, max_bytes: int=1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Entries handed out by `get` or `put` and not yet materialized, which `_evict` skips
+        self.pending: set[str] = set()
+        self.index: OrderedDict[str, dict[str, Any]] = OrderedDict()
+
+        index_path = self.cache_dir / self.index_name
+        if index_path.exists():
+            with open(index_path, "r") as index_file:
+                entries = json.load(index_file)
+            for key, entry in sorted(entries.items(), key=lambda e: e[1]["last_used"]):
+                if self.path(key).exists():
+                    self.index[key] = entry
+
+    @staticmethod
+    def key(voice_id: str, model_id: str, voice_settings: dict[str, Any], text: str) -> str:
+        payload = json.dumps(
+            {"voice_id": voice_id, "model_id": model_id, "voice_settings": voice_settings, "text": text},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self.index.values())
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.wav"
+
+    def get(self, key: str) -> Optional[Path]:
+        """Return the path of the cached audio for `key`, or None on a miss."""
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.index[key]["last_used"] = time.time()
+            self.index.move_to_end(key)
+            self.pending.add(key)
+            return self.path(key)
+
+    def put(self, key: str, data: bytes) -> Path:
+        """Store `data` under `key`, evicting least recently used entries if over budget."""
+        path = self.path(key)
+        atomic_write(path, data)
+        with self.lock:
+            self.index[key] = {"size": len(data), "last_used": time.time()}
+            self.index.move_to_end(key)
+            self.pending.add(key)
+            self._evict()
+            self._save()
+        return path
+
+    def materialize(self, key: str, target: Path):
+        """Make the cached audio for `key` available at `target`.
+
+        Hard links are used where possible so materializing costs no extra disk space; an
+        evicted entry leaves the linked target intact.  Once materialized the entry can be
+        evicted again.
+        """
+        source = self.path(key)
+        try:
+            if target.exists():
+                if os.path.samefile(source, target):
+                    return
+                target.unlink()
+            try:
+                os.link(source, target)
+            except OSError:
+                atomic_write(target, source.read_bytes())
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+                # Trim back what was kept over budget while this entry was pending
+                if self.size > self.max_bytes:
+                    self._evict()
+                    self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.index), "bytes": self.size}
+
+    def _evict(self):
+        total = self.size
+        # Entries waiting to be materialized are kept, which includes the one just added
+        #   even if it alone exceeds the budget
+        for key in [key for key in self.index if key not in self.pending]:
+            if total <= self.max_bytes:
+                break
+            entry = self.index.pop(key)
+            total -= entry["size"]
+            self.path(key).unlink(missing_ok=True)
+            logger.debug(f"evicted cached audio {key} ({entry['size']} bytes)")
+
+    def _save(self):
+        atomic_write(self.cache_dir / self.index_name, json.dumps(self.index).encode("utf-8"))
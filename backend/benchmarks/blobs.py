@@ -0,0 +1,59 @@
+import time
+
+import click
+import cv2 # type: ignore
+import numpy as np
+from scipy.interpolate import RectBivariateSpline # type: ignore
+
+from backend.numpy_generate_blobs import BilinearUpscaler
+
+
+def spline_upscale(small_frame: np.ndarray, width: int, height: int) -> np.ndarray:
+    """The upscale and color conversion the blob generator used to do for every frame."""
+    small_height, small_width = small_frame.shape[:2]
+    x = np.arange(small_width)
+    y = np.arange(small_height)
+    x_new = np.linspace(0, small_width - 1, width)
+    y_new = np.linspace(0, small_height - 1, height)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    for i in range(3):
+        interpolator = RectBivariateSpline(y, x, small_frame[..., i], kx=1, ky=1)
+        frame[..., i] = interpolator(y_new, x_new)
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+@click.command()
+@click.option("--width", default=640, type=int, help="Video width")
+@click.option("--height", default=480, type=int, help="Video height")
+@click.option("--frames", default=50, type=int, help="Number of frames upscaled per scale factor")
+@click.option("--scale-factor", "scale_factors", default=[1, 2, 4, 8], type=int, multiple=True, help="Factors the frames are upscaled by")
+def main(width: int, height: int, frames: int, scale_factors: list[int]) -> None:
+    """Compare the per-frame cost of the old spline upscaling and color conversion with `BilinearUpscaler`."""
+    rng = np.random.default_rng(0)
+    for scale_factor in scale_factors:
+        small_frames = rng.integers(0, 256, (frames, height // scale_factor, width // scale_factor, 3), dtype=np.uint8)
+        upscale = BilinearUpscaler(small_frames.shape[1:3], (height, width))
+
+        start = time.perf_counter()
+        expected = [spline_upscale(small_frame, width, height) for small_frame in small_frames]
+        spline_ms = (time.perf_counter() - start) / frames * 1000
+
+        # The palette emits BGR now, so the small frames are already in the video's order
+        small_frames = np.ascontiguousarray(small_frames[..., ::-1])
+        start = time.perf_counter()
+        for small_frame in small_frames:
+            upscale(small_frame)
+        bilinear_ms = (time.perf_counter() - start) / frames * 1000
+        max_error = max(
+            int(np.abs(upscale(small_frame).astype(np.int16) - expected_frame).max())
+            for small_frame, expected_frame in zip(small_frames, expected)
+        )
+        print(
+            f"scale factor {scale_factor}:"
+            f"  spline {spline_ms:7.2f}ms per frame"
+            f"  bilinear {bilinear_ms:7.2f}ms per frame"
+            f"  saved {spline_ms - bilinear_ms:7.2f}ms"
+            f"  max difference {max_error}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import io
+import json
+import threading
+import time
+import wave
+import zlib
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from backend.alignment import AlignedFragment
+from backend.audio_buffer import SampleBuffer
+
+
+def speech_like(
+    duration_s: float,
+    sample_rate: int=44100,
+    syllables_per_s: float=4.0,
+    seed: int=0,
+) -> npt.NDArray[np.float32]:
+    """Synthesize a mono float32 signal of shape (1, samples) that loosely resembles speech.
+
+    A wandering pitch with a few harmonics is gated on and off at roughly syllable rate so
+    time stretching and silence detection have realistic transients to work with.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * sample_rate)) / sample_rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t + rng.uniform(0, np.pi))
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voiced = sum(np.sin(phase * harmonic) / harmonic for harmonic in range(1, 6))
+    envelope = np.clip(np.sin(2 * np.pi * syllables_per_s / 2 * t) ** 2 * 1.5 - 0.2, 0, 1)
+    signal = 0.25 * voiced * envelope + 0.002 * rng.standard_normal(t.size)
+    return signal.astype(np.float32)[np.newaxis, :]
+
+def clause_with_silences(
+    fragment_count: int=10,
+    fragment_s: float=1.5,
+    silence_s: float=0.6,
+    sample_rate: int=44100,
+    seed: int=0,
+) -> tuple[SampleBuffer, list[AlignedFragment]]:
+    """Synthesize a clause of speech-like fragments separated by silences of known length.
+
+    The returned alignment stands in for aeneas, each fragment spanning its speech and the
+    silence after it like forced alignment does.
+    """
+    silence = np.zeros((1, int(silence_s * sample_rate)), dtype=np.float32)
+    parts = [silence]
+    alignment = []
+    for ix in range(fragment_count):
+        begin = Decimal(sum(part.shape[1] for part in parts)) / sample_rate
+        parts += [speech_like(fragment_s, sample_rate, seed=seed + ix), silence]
+        end = Decimal(sum(part.shape[1] for part in parts)) / sample_rate
+        text = " ".join(["sleepy", "little", "clouds", "drifting", "slowly", "home"][:ix % 4 + 3])
+        alignment.append(AlignedFragment(begin, end, text, index=ix))
+    return SampleBuffer.from_float(np.concatenate(parts, axis=1), sample_rate), alignment
+
+def wav_bytes(samples: npt.NDArray[np.float32], sample_rate: int=44100) -> bytes:
+    """Encode (channels, samples) float audio as a 16-bit WAV file."""
+    buffer = SampleBuffer.from_float(samples, sample_rate)
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav_file:
+        wav_file.setnchannels(buffer.channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(buffer.to_pcm().tobytes())
+    return output.getvalue()
+
+
+class StubTTSServer:
+    """A local stand-in for the TTS provider's API, serving speech-like audio for any text.
+
+    Use as a context manager and point `fetch_audio` at `url`.  Audio is about as long as
+    the text would take to read, and every request waits `latency_s` like a real provider.
+
+    :param latency_s: How long each request takes.
+    :param sample_rate: The sample rate of the returned audio.
+    """
+    def __init__(self, latency_s: float=0.0, sample_rate: int=44100):
+        self.latency_s = latency_s
+        self.sample_rate = sample_rate
+        self.requests = 0
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        assert self.server
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def __enter__(self) -> "StubTTSServer":
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._respond(self, json.dumps({"voices": [{"name": "Stub", "voice_id": "stub"}]}).encode(), "application/json")
+
+            def do_POST(self):
+                stub.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(stub.latency_s)
+                samples = speech_like(max(0.5, len(body["text"]) / 15), stub.sample_rate, seed=zlib.crc32(body["text"].encode()))
+                stub._respond(self, wav_bytes(samples, stub.sample_rate), "audio/wav")
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_):
+        assert self.server
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def _respond(handler: BaseHTTPRequestHandler, body: bytes, content_type: str):
+        handler.send_response(200)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
@@ -0,0 +1,57 @@
+import json
+import subprocess
+import sys
+import time
+
+import click
+
+from backend.process_audio import count_syllables, count_word_syllables, get_syllable_dictionary, get_tokenizer
+
+
+def fragment_texts(script_path: str) -> list[str]:
+    with open(script_path, "r") as script_file:
+        script = json.load(script_file)
+    return [text for section in script["sections"] for clause in section["clauses"] for text in clause]
+
+def time_per_fragment(texts: list[str], count) -> float:
+    start = time.perf_counter()
+    for text in texts:
+        count(text)
+    return (time.perf_counter() - start) / len(texts)
+
+@click.command()
+@click.option("--script", default="scripts/demo.json", type=click.Path(exists=True), help="Script whose fragments are counted")
+@click.option("--repeats", default=5, type=int, help="Number of timed passes over the script")
+def main(script: str, repeats: int) -> None:
+    """Time importing the audio pipeline and counting syllables per fragment."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import backend.process_audio"], check=True)
+    print(f"import backend.process_audio: {(time.perf_counter() - start) * 1000:8.1f}ms (including interpreter start)")
+
+    start = time.perf_counter()
+    get_tokenizer()
+    get_syllable_dictionary()
+    print(f"first tokenizer load:         {(time.perf_counter() - start) * 1000:8.1f}ms")
+
+    texts = fragment_texts(script)
+    count_word_syllables.cache_clear()
+    print(f"cold syllable count:          {time_per_fragment(texts, count_syllables) * 1e6:8.1f}us per fragment")
+    warm = min(time_per_fragment(texts, count_syllables) for _ in range(repeats))
+    print(f"warm syllable count:          {warm * 1e6:8.1f}us per fragment ({count_word_syllables.cache_info()})")
+
+    try:
+        import spacy
+        nlp = spacy.load("en_core_web_sm")
+    except OSError:
+        print("en_core_web_sm isn't installed, skipping the full pipeline comparison")
+        return
+    dic = get_syllable_dictionary()
+    def full_pipeline_count(text: str) -> int:
+        return sum([len(dic.positions(token.text)) + 1 for token in nlp(text)])
+    full = min(time_per_fragment(texts, full_pipeline_count) for _ in range(repeats))
+    print(f"en_core_web_sm syllable count:{full * 1e6:8.1f}us per fragment")
+    mismatched = sum(full_pipeline_count(text) != count_syllables(text) for text in texts)
+    print(f"fragments counted differently: {mismatched} of {len(texts)}")
+
+if __name__ == "__main__":
+    main()
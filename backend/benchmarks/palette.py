@@ -0,0 +1,53 @@
+import time
+
+import click
+import numpy as np
+
+from backend.numpy_generate_blobs import PaletteLUT, noise_to_color_array, process_colors
+from backend.simplex_noise import rescaled_noise_grid
+
+
+def random_palette(num_colors: int, rng: np.random.Generator) -> str:
+    colors = rng.integers(0, 256, (num_colors, 3))
+    weights = rng.integers(1, 6, num_colors)
+    return ",".join(f"#{r:02X}{g:02X}{b:02X}:{weight}" for (r, g, b), weight in zip(colors, weights))
+
+@click.command()
+@click.option("--width", default=640, type=int, help="Frame width")
+@click.option("--height", default=480, type=int, help="Frame height")
+@click.option("--frames", default=20, type=int, help="Number of frames colorized per palette")
+@click.option("--colors", "palette_sizes", default=[2, 5, 10, 20], type=int, multiple=True, help="Number of colors in the palette")
+@click.option("--lut-size", default=4096, type=int, help="Number of entries in the lookup table")
+def main(width: int, height: int, frames: int, palette_sizes: list[int], lut_size: int) -> None:
+    """Compare colorizing frames with `noise_to_color_array` and `PaletteLUT` across palette sizes."""
+    rng = np.random.default_rng(0)
+    x_coords, y_coords = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    noise_frames = [
+        (rescaled_noise_grid(x_coords + t, y_coords + t, 0.0022) + rescaled_noise_grid(x_coords - t, y_coords - t, 0.0022)) % 1
+        for t in range(frames)
+    ]
+    for palette_size in palette_sizes:
+        color_array, cumulative_weights = process_colors(random_palette(palette_size, rng))
+
+        start = time.perf_counter()
+        expected = [noise_to_color_array(noise, color_array, cumulative_weights) for noise in noise_frames]
+        direct_ms = (time.perf_counter() - start) / frames * 1000
+
+        colorize = PaletteLUT(color_array, cumulative_weights, lut_size)
+        start = time.perf_counter()
+        for noise in noise_frames:
+            colorize(noise)
+        lut_ms = (time.perf_counter() - start) / frames * 1000
+        max_error = max(
+            int(np.abs(colorize(noise).astype(np.int16) - expected_frame).max())
+            for noise, expected_frame in zip(noise_frames, expected)
+        )
+        print(
+            f"{palette_size:3d} colors:"
+            f"  direct {direct_ms:7.2f}ms per frame"
+            f"  lut {lut_ms:7.2f}ms per frame"
+            f"  max difference {max_error}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+import click
+
+from backend.audio_buffer import SampleBuffer, write_wav
+from backend.benchmarks.fixtures import speech_like
+from backend.pcm_store import PcmStore
+from backend.script_catalog import ScriptCatalog
+
+
+def directory_bytes(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.rglob("*") if path.is_file())
+
+@click.command()
+@click.option("--script", default="scripts/demo.json", type=click.Path(exists=True, dir_okay=False), help="Script whose clauses are synthesized")
+@click.option("--sample-rate", default=44100, type=int, help="Sample rate of the synthesized clause audio")
+@click.option("--repeats", default=3, type=int, help="Number of timed passes over every clause")
+def main(script: str, sample_rate: int, repeats: int) -> None:
+    """Compare decoding clause WAVs on every run against the memory-mapped PCM store.
+
+    Every clause of the script is synthesized as about as long as the TTS provider would
+    read it, then the disk usage of the WAVs, the store and its FLAC archive is reported
+    with the time taken to get every clause's samples each way.
+    """
+    catalog = ScriptCatalog(Path(script).parent, Path(tempfile.mkdtemp()) / "catalog.json", workers=1)
+    catalog.scan()
+    parsed = catalog.load(Path(script))
+    with tempfile.TemporaryDirectory() as work_dir:
+        raw_dir = Path(work_dir, "raw")
+        raw_dir.mkdir()
+        sources = {}
+        for section_ix, section in enumerate(parsed.sections):
+            for clause_ix, clause in enumerate(section.clauses):
+                name = f"{section_ix}_{section.name}_{clause_ix}"
+                samples = speech_like(max(0.5, len(clause.text) / 15), sample_rate, seed=zlib.crc32(clause.text.encode()))
+                sources[name] = raw_dir / f"{name}.wav"
+                write_wav(sources[name], SampleBuffer.from_float(samples, sample_rate))
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for source in sources.values():
+                SampleBuffer.from_file(source).samples.sum(dtype="int64")
+        wav_ms = (time.perf_counter() - start) / repeats * 1000
+
+        store = PcmStore(Path(work_dir, "pcm"))
+        start = time.perf_counter()
+        store.add(sources)
+        first_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for _ in range(repeats):
+            # A new store every pass, like a new run or a worker process mapping the file
+            reopened = PcmStore(Path(work_dir, "pcm"))
+            reopened.add(sources)
+            for name in sources:
+                reopened.get(name).samples.sum(dtype="int64")
+        store_ms = (time.perf_counter() - start) / repeats * 1000
+
+        store.archive(Path(work_dir, "archive"))
+        print(f"{len(sources)} clauses of {script}")
+        print(f"  WAV files:    {directory_bytes(raw_dir) / 1e6:8.2f}MB  {wav_ms:8.1f}ms to decode every run")
+        print(f"  PCM store:    {directory_bytes(Path(work_dir, 'pcm')) / 1e6:8.2f}MB  {first_ms:8.1f}ms to decode once, then {store_ms:.1f}ms per run")
+        print(f"  FLAC archive: {directory_bytes(Path(work_dir, 'archive')) / 1e6:8.2f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import time
+from typing import Optional
+
+import click
+import numpy as np
+from pydub import silence # type: ignore
+
+from backend.audio_buffer import SampleBuffer
+from backend.benchmarks.fixtures import speech_like
+from backend.loudness import ClauseLoudness
+
+
+def pydub_trim(buffer: SampleBuffer, windows: list[tuple[int, int]], min_silence_ms: int, target_dbfs: int):
+    bounds = []
+    for start, end in windows:
+        segment = buffer[start:end].to_segment()
+        nonsilent = silence.detect_nonsilent(segment, min_silence_ms, -70)
+        if nonsilent:
+            nonsilent_segment = segment[nonsilent[0][0]:nonsilent[0][1]]
+            nonsilent_segment.apply_gain(target_dbfs - nonsilent_segment.dBFS)
+        bounds.append(tuple(nonsilent[0]) if nonsilent else None)
+    return bounds
+
+def vectorized_trim(buffer: SampleBuffer, windows: list[tuple[int, int]], min_silence_ms: int, target_dbfs: int):
+    loudness = ClauseLoudness(buffer)
+    bounds = loudness.nonsilent_bounds(windows, min_silence_ms, -70)
+    for (start, _), nonsilent in zip(windows, bounds):
+        if nonsilent:
+            nonsilent_start = buffer.ms_to_samples(start) + buffer.ms_to_samples(nonsilent[0])
+            nonsilent_end = buffer.ms_to_samples(start) + buffer.ms_to_samples(nonsilent[1])
+            samples = buffer.samples[nonsilent_start:nonsilent_end].T.astype(np.float32)
+            samples *= 10 ** ((target_dbfs - loudness.dbfs(nonsilent_start, nonsilent_end)) / 20)
+    return bounds
+
+@click.command()
+@click.option("--audio", type=click.Path(exists=True, dir_okay=False), help="Clause audio to trim, e.g. a file from audio/demo/raw")
+@click.option("--duration", default=20.0, type=float, help="Length of the synthetic clause when --audio isn't given")
+@click.option("--fragments", default=10, type=int, help="Number of equal fragment windows to split the clause into")
+@click.option("--min-silence-ms", default=250, type=int, help="The shortest stretch of audio counted as silence")
+@click.option("--repeats", default=3, type=int, help="Number of timed runs per implementation")
+def main(audio: Optional[str], duration: float, fragments: int, min_silence_ms: int, repeats: int) -> None:
+    """Compare pydub's silence detection and gain against the vectorized trimming stage."""
+    if audio:
+        buffer = SampleBuffer.from_file(audio)
+    else:
+        samples = speech_like(duration, syllables_per_s=1.5)
+        # Cut hard silences into the signal so every fragment has something to trim
+        for start in range(0, samples.shape[1], 44100 * 2):
+            samples[:, start:start + 44100 // 2] = 0
+        buffer = SampleBuffer.from_float(samples, 44100)
+
+    edges = np.linspace(0, len(buffer), fragments + 1).astype(int)
+    windows = list(zip(edges[:-1], edges[1:]))
+
+    results = {}
+    for name, trim in (("pydub", pydub_trim), ("vectorized", vectorized_trim)):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            results[name] = trim(buffer, windows, min_silence_ms, -20)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f"{name:>10}: {elapsed * 1000:8.2f}ms per clause ({len(buffer) / 1000:.1f}s, {fragments} fragments)")
+
+    differences = [
+        max(abs(a - b) for a, b in zip(expected, actual))
+        for expected, actual in zip(results["pydub"], results["vectorized"])
+        if expected and actual
+    ]
+    mismatched = sum((expected is None) != (actual is None) for expected, actual in zip(results["pydub"], results["vectorized"]))
+    print(f"largest bound difference: {max(differences, default=0)}ms, fragments silent in only one: {mismatched}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import io
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from contextlib import ExitStack, redirect_stdout
+from pathlib import Path
+from typing import Callable, Optional
+from uuid import uuid4
+
+import click
+import numpy as np
+
+from backend.audio_buffer import StreamingWavWriter
+from backend.audio_cache import AudioCache
+from backend.benchmarks.fixtures import StubTTSServer, clause_with_silences
+from backend.common import CACHE_DIR
+from backend.fetch_audio import generate_audio_files
+from backend.main import export_clause_audio, generate_report
+from backend.numpy_generate_blobs import (
+    BlobSettings, DEFAULT_COLORS, FrameRenderer, PaletteLUT, noise_to_color_array, process_colors
+)
+from backend.process_audio import process_fragments
+from backend.schemas import Clause, Fragment, Section
+from backend.simplex_noise import rescaled_noise_grid
+from backend.time_stretch import get_stretcher
+
+# A benchmark sets up its inputs and returns the function that's timed, called once per repeat.
+#   Anything it enters on the stack is closed once every repeat has run.
+Benchmark = Callable[[Path, ExitStack], Callable[[], None]]
+
+
+def fetch_benchmark(work_dir: Path, stack: ExitStack) -> Callable[[], None]:
+    clauses = [("section", [f"Breathe in slowly, clause {ix}...\nAnd let it go..." for ix in range(8)])]
+    # Started once so only the fetching is timed, not the server starting up
+    server = stack.enter_context(StubTTSServer(latency_s=0.05))
+
+    def run():
+        # A fresh cache every run so every clause goes to the stub provider
+        with tempfile.TemporaryDirectory(dir=work_dir) as run_dir, redirect_stdout(io.StringIO()):
+            cache = AudioCache(Path(run_dir, "cache"))
+            generate_audio_files(
+                "key", "stub", Path(run_dir, "raw"), clauses, cache,
+                max_workers=4, requests_per_second=1000, api_url=server.url,
+            )
+    return run
+
+def process_fragments_benchmark(_: Path, __: ExitStack) -> Callable[[], None]:
+    buffer, alignment = clause_with_silences(fragment_count=10)
+    stretcher = get_stretcher()
+
+    def run():
+        process_fragments(buffer, alignment, noise_scale=100, target_speech_rate=3.5, stretcher=stretcher)
+    return run
+
+def rendered_clause():
+    buffer, alignment = clause_with_silences(fragment_count=10)
+    fragments = process_fragments(buffer, alignment, noise_scale=100, target_speech_rate=3.5)
+    return Clause(id=uuid4(), fragments=[Fragment(id=uuid4(), **fragment.dict()) for fragment in fragments])
+
+def concatenate_benchmark(work_dir: Path, _: ExitStack) -> Callable[[], None]:
+    clause = rendered_clause()
+
+    def run():
+        # Like `main.main`, every fragment's extended audio is streamed into the output
+        with StreamingWavWriter(work_dir / "output.wav") as writer:
+            for _ in range(20):
+                for fragment in clause.fragments:
+                    writer.write(fragment.processed_audio.extended)
+    return run
+
+def report_benchmark(work_dir: Path, _: ExitStack) -> Callable[[], None]:
+    clause = rendered_clause()
+    # The page template lives outside the repo, a minimal one stands in for it
+    (work_dir / "report_template.html").write_text("<html><body>{{ html_content }}</body></html>")
+
+    def run():
+        sections = [
+            Section(id=uuid4(), name=f"section {section_ix}", audio=None, clauses=[
+                Clause(id=uuid4(), fragments=[fragment.copy(deep=True) for fragment in clause.fragments])
+                for _ in range(3)
+            ])
+            for section_ix in range(3)
+        ]
+        for section_ix, section in enumerate(sections):
+            for clause_ix, section_clause in enumerate(section.clauses):
+                export_clause_audio(section_ix, clause_ix, section_clause, work_dir / "report")
+        generate_report(sections, work_dir / "report", open_browser=False)
+    return run
+
+def noise_frame(width: int=320, height: int=240) -> np.ndarray:
+    x_coords, y_coords = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    return (rescaled_noise_grid(x_coords + 3, y_coords + 5, 0.0022) + rescaled_noise_grid(x_coords - 3, y_coords - 5, 0.0022)) % 1
+
+def noise_to_color_array_benchmark(_: Path, __: ExitStack) -> Callable[[], None]:
+    noise = noise_frame()
+    color_array, cumulative_weights = process_colors(DEFAULT_COLORS, bgr=True)
+
+    def run():
+        noise_to_color_array(noise, color_array, cumulative_weights)
+    return run
+
+def palette_lut_benchmark(_: Path, __: ExitStack) -> Callable[[], None]:
+    noise = noise_frame()
+    colorize = PaletteLUT(*process_colors(DEFAULT_COLORS, bgr=True))
+
+    def run():
+        colorize(noise)
+    return run
+
+def blob_frames_benchmark(_: Path, __: ExitStack) -> Callable[[], None]:
+    render = FrameRenderer(BlobSettings(max_frames=600, scale_factor=2))
+
+    def run():
+        for t in range(10):
+            render(t)
+    return run
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "fetch": fetch_benchmark,
+    "process_fragments": process_fragments_benchmark,
+    "concatenate": concatenate_benchmark,
+    "report": report_benchmark,
+    "noise_to_color_array": noise_to_color_array_benchmark,
+    "palette_lut": palette_lut_benchmark,
+    "blob_frames": blob_frames_benchmark,
+}
+
+def run_benchmark(benchmark: Benchmark, repeats: int) -> float:
+    """The median time of `repeats` runs after a warm up run."""
+    with tempfile.TemporaryDirectory() as work_dir, ExitStack() as stack:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            run = benchmark(Path(work_dir), stack)
+            run()
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+    return statistics.median(timings)
+
+@click.command()
+@click.option("--baseline", default=str(CACHE_DIR / "benchmark_baseline.json"), type=click.Path(dir_okay=False), help="Baseline results to compare against")
+@click.option("--save-baseline", is_flag=True, help="Store these results as the baseline instead of comparing")
+@click.option("--threshold", default=0.2, type=float, help="Slowdown over the baseline flagged as a regression, 0.2 is 20%")
+@click.option("--repeats", default=5, type=int, help="Number of timed runs per benchmark, the median is reported")
+@click.option("--only", "names", multiple=True, type=click.Choice(list(BENCHMARKS)), help="Only run these benchmarks")
+def main(baseline: str, save_baseline: bool, threshold: float, repeats: int, names: list[str]) -> None:
+    """Time the audio and video pipelines on synthetic fixtures and compare against a baseline.
+
+    Everything runs offline: clauses are synthesized with known silences and a canned
+    alignment, and TTS requests go to a local stub server.  Exits with status 1 when any
+    benchmark regressed past the threshold.
+    """
+    baseline_path = Path(baseline)
+    previous: Optional[dict] = None
+    if baseline_path.exists() and not save_baseline:
+        with open(baseline_path, "r") as baseline_file:
+            previous = json.load(baseline_file)
+        if previous["machine"] != platform.platform():
+            print(f"Baseline was recorded on {previous['machine']}, timings may not be comparable")
+
+    results = {}
+    regressions = []
+    for name in names or BENCHMARKS:
+        seconds = run_benchmark(BENCHMARKS[name], repeats)
+        results[name] = seconds
+        line = f"{name:>22}: {seconds * 1000:9.2f}ms"
+        if previous and name in previous["results"]:
+            change = seconds / previous["results"][name] - 1
+            line += f"  {change:+7.1%} vs baseline"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if save_baseline or previous is None:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, "w") as baseline_file:
+            json.dump({"machine": platform.platform(), "repeats": repeats, "results": results}, baseline_file, indent=2)
+        print(f"Saved baseline to {baseline_path}")
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import shutil
+import time
+
+import click
+
+from backend.benchmarks.fixtures import speech_like
+from backend.time_stretch import STRETCHERS
+
+
+@click.command()
+@click.option("--duration", default=3.0, type=float, help="Length of each synthetic fragment in seconds")
+@click.option("--repeats", default=10, type=int, help="Number of fragments stretched per tempo")
+@click.option("--tempo", "tempos", default=[-30, -10, 10, 30], type=int, multiple=True, help="Tempo changes in percent")
+@click.option("--sample-rate", default=44100, type=int, help="Sample rate of the synthetic fragments")
+def main(duration: float, repeats: int, tempos: list[int], sample_rate: int) -> None:
+    """Compare time stretch backends for throughput and output duration accuracy."""
+    samples = speech_like(duration, sample_rate)
+    for name, stretcher_class in STRETCHERS.items():
+        if name == "soundstretch" and not shutil.which("SoundStretch"):
+            print(f"{name:>12}: skipped, SoundStretch is not on the PATH")
+            continue
+        try:
+            stretcher = stretcher_class()
+        except ImportError as e:
+            print(f"{name:>12}: skipped, {e}")
+            continue
+
+        for tempo_pct in tempos:
+            expected_ms = duration * 1000 / (1 + tempo_pct / 100)
+            errors_ms = []
+            start = time.perf_counter()
+            for _ in range(repeats):
+                output = stretcher.stretch(samples, sample_rate, tempo_pct)
+                errors_ms.append(output.shape[-1] / sample_rate * 1000 - expected_ms)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>12}: tempo {tempo_pct:+4d}%"
+                f"  {elapsed / repeats * 1000:8.2f}ms per fragment"
+                f"  {duration * repeats / elapsed:7.1f}x realtime"
+                f"  duration error {max(errors_ms, key=abs):+7.2f}ms"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
 import os
 import re
+import tempfile
+from collections import deque
+from concurrent.futures import Executor, Future
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
 
 import noise # type: ignore
 
+# Shared home of the caches that let re-renders skip work whose inputs haven't changed
+CACHE_DIR = Path("audio", ".cache")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
 
 def list_directories(path: str) -> list[Path]:
     dirs = []
@@ -16,13 +25,50 @@ def list_directories(path: str) -> list[Path]:
 
 def find_files_in_directory(directory: str, regex: Optional[str]=None) -> list[Path]:
     found_files = []
+    pattern = re.compile(regex) if regex else None
     for root, _, files in os.walk(directory):
         for file in files:
-            if regex and not re.search(regex, os.path.basename(file)):
+            if pattern and not pattern.search(file):
                 continue
             found_files.append(Path(root, file))
     return found_files
 
+def atomic_write(path: Path, data: bytes):
+    """Write `data` to `path` so readers only ever see the old file or the complete new one.
+
+    The bytes go to a temp file in the same directory which is then renamed over `path`,
+    so a crash mid-write leaves a stray temp file instead of a truncated target.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def rescaled_noise(x, y, scale):
     noise_value = noise.snoise2(x * scale, y * scale)
     return (noise_value + 1) / 2
+
+def bounded_map(executor: Optional[Executor], fn: Callable[[T], R], items: Iterable[T], max_in_flight: int) -> Iterator[R]:
+    """Like `executor.map`, but with at most `max_in_flight` tasks submitted and not yet consumed.
+
+    Results are yielded in the order of `items`, and since new work is only submitted as
+    results are consumed, a slow consumer bounds how many results are held in memory.
+    Without an executor the items are mapped lazily in this process.
+    """
+    if executor is None:
+        yield from map(fn, items)
+        return
+    in_flight: deque[Future[R]] = deque()
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(fn, item))
+    while in_flight:
+        yield in_flight.popleft().result()
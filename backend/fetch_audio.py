@@ -1,15 +1,71 @@
+import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from typing import List, Tuple
+from backend.audio_cache import AudioCache
+from backend.common import CACHE_DIR, atomic_write
+from backend.profiling import profiler
+from backend.schemas import Script
 
-from pathlib import Path
 
-from backend.schemas import Script
+logger = logging.getLogger(__name__)
 
+API_URL = "https://api.elevenlabs.io/v1"
+MODEL_ID = "eleven_multilingual_v1"
+VOICE_SETTINGS = {
+    "stability": 0.55,
+    "similarity_boost": 0.55
+}
+# How long the list of available voices is reused before asking the provider again
+VOICES_TTL_S = 24 * 60 * 60
+# Responses worth retrying: rate limited or a transient failure on the provider's side
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 ProcessedClauses = List[Tuple[str, List[str]]]
 
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how many requests start per second.
+
+    :param rate: Tokens added per second (the sustained request rate).
+    :param capacity: Maximum number of tokens that can accumulate (the allowed burst).
+    """
+    def __init__(self, rate: float, capacity: int=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """Create an HTTP session whose connection pool can serve `pool_size` concurrent requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 def process_clauses(script: Script) -> ProcessedClauses:
     result = []
     for section in script.sections:
@@ -21,57 +77,138 @@ def process_clauses(script: Script) -> ProcessedClauses:
         result.append((name, formatted_clauses))
     return result
 
-def get_voice_id(api_key: str, voice_name: str) -> str:
-    url = "https://api.elevenlabs.io/v1/voices"
+def get_voices(api_key: str, api_url: str=API_URL, cache_path: Optional[Path]=None, refresh: bool=False) -> list[dict]:
+    """List the provider's voices, reusing the copy at `cache_path` while it's under `VOICES_TTL_S` old."""
+    if cache_path and cache_path.exists() and not refresh:
+        if time.time() - cache_path.stat().st_mtime < VOICES_TTL_S:
+            with open(cache_path, "r") as cache_file:
+                return json.load(cache_file)
+
+    url = f"{api_url}/voices"
     headers = {"xi-api-key": api_key}
     response = requests.get(url, headers=headers)
     response.raise_for_status()
 
-    voices = response.json()
-    for voice in voices['voices']:
-        if voice['name'] == voice_name:
-            return voice['voice_id']
+    voices = response.json()['voices']
+    if cache_path:
+        atomic_write(cache_path, json.dumps(voices).encode("utf-8"))
+    return voices
+
+def get_voice_id(api_key: str, voice_name: str, api_url: str=API_URL, cache_path: Optional[Path]=None) -> str:
+    # A voice missing from the cached list may have been added since, so check again uncached
+    for refresh in (False, True):
+        for voice in get_voices(api_key, api_url, cache_path, refresh):
+            if voice['name'] == voice_name:
+                return voice['voice_id']
+        if not cache_path:
+            break
 
     raise Exception(f"Voice not found: {voice_name}")
 
-def get_audio(api_key: str, voice_id: str, text: str) -> bytes:
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+def get_audio(
+    api_key: str, 
+    voice_id: str, 
+    text: str, 
+    session: Optional[requests.Session]=None, 
+    rate_limiter: Optional[TokenBucket]=None,
+    model_id: str=MODEL_ID,
+    voice_settings: dict=VOICE_SETTINGS,
+    max_retries: int=5,
+    backoff_ms: int=500,
+    api_url: str=API_URL,
+) -> bytes:
+    """Fetch the speech for `text` from the TTS provider.
+
+    Rate limited (429) and server error (5xx) responses are retried with exponential backoff,
+    honoring the `Retry-After` header when the provider sends one.  Every attempt, retries
+    included, waits on `rate_limiter` so retries can't push us over the provider's limit.
+    """
+    url = f"{api_url}/text-to-speech/{voice_id}"
     headers = {"xi-api-key": api_key, "Content-Type": "application/json"}
     data = {
         "text": text,
-        "model_id": "eleven_multilingual_v1",
-        "voice_settings": {
-            "stability": 0.55,
-            "similarity_boost": 0.55
-        }
+        "model_id": model_id,
+        "voice_settings": voice_settings
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    http = session or requests
+    for attempt in range(max_retries + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = http.post(url, headers=headers, json=data)
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            break
+        retry_after = response.headers.get("Retry-After", "")
+        delay_ms = float(retry_after) * 1000 if retry_after.isdigit() else backoff_ms * 2 ** attempt
+        logger.warning(
+            f"TTS request returned {response.status_code}, retrying in {delay_ms:.0f}ms"
+            f" (attempt {attempt + 1} of {max_retries})"
+        )
+        time.sleep(delay_ms / 1000)
     response.raise_for_status()
 
     return response.content
 
-def generate_audio_files(api_key: str, voice_id: str, write_dir: Path, processed_clauses: ProcessedClauses):
+def generate_audio_files(
+    api_key: str, 
+    voice_id: str, 
+    write_dir: Path, 
+    processed_clauses: ProcessedClauses,
+    cache: AudioCache,
+    max_workers: int=4,
+    requests_per_second: float=2.0,
+    api_url: str=API_URL,
+):
+    """Write the audio for every clause to `write_dir`, only fetching clauses missing from `cache`.
+
+    Up to `max_workers` requests are in flight at once over a shared connection pool, and
+    `requests_per_second` caps how quickly new requests are started.  Files are written
+    atomically so an interrupted run never leaves a truncated file behind.
+    """
+    write_dir.mkdir(parents=True, exist_ok=True)
+    pending = []
     for section_index, (section_name, clauses) in enumerate(processed_clauses):
         for clause_index, clause in enumerate(clauses):
             file_name = f"{section_index}_{section_name}_{clause_index}.wav"
             file_path = write_dir / file_name
-            if os.path.exists(file_path):
-                print(f"Skipped existing audio file: {file_path}")
+            key = AudioCache.key(voice_id, MODEL_ID, VOICE_SETTINGS, clause)
+            if cache.get(key):
+                cache.materialize(key, file_path)
+                profiler.count("fetch", cache_hits=1)
+                print(f"Reused cached audio file: {file_path}")
                 continue
-            audio = get_audio(api_key, voice_id, clause)
-            with open(file_path, "wb") as file:
-                file.write(audio)
-            print(f"Saved audio file: {file_path}")
+            pending.append((file_path, key, clause))
+
+    if pending:
+        rate_limiter = TokenBucket(requests_per_second, capacity=max_workers)
+        with create_session(max_workers) as session:
+            def fetch_clause(job: Tuple[Path, str, str]):
+                file_path, key, clause = job
+                audio = get_audio(api_key, voice_id, clause, session, rate_limiter, api_url=api_url)
+                cache.put(key, audio)
+                cache.materialize(key, file_path)
+                profiler.count("fetch", bytes=len(audio), cache_misses=1)
+                print(f"Saved audio file: {file_path}")
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Consume the results so the first failed fetch is raised here
+                for _ in executor.map(fetch_clause, pending):
+                    pass
+
+    cache.save()
+    stats = cache.stats()
+    print(f"TTS cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bytes']} bytes cached")
 
-def fetch(voice_name: str, script: Script, write_dir: Path):
+def fetch(voice_name: str, script: Script, write_dir: Path, max_workers: int=4, cache_dir: Path=CACHE_DIR):
     processed_clauses = process_clauses(script)
     print(processed_clauses)
 
     api_key = os.getenv("ELEVEN_API_KEY")
     if not api_key:
         raise Exception("ELEVEN_API_KEY environment variable not set")
-    voice_id = get_voice_id(api_key, voice_name)
+    api_url = os.getenv("ELEVEN_API_URL", API_URL)
+    cache = AudioCache(cache_dir / "tts")
+    voice_id = get_voice_id(api_key, voice_name, api_url, cache_dir / "voices.json")
     print(f"Voice ID for {voice_name}: {voice_id}")
     
-    generate_audio_files(api_key, voice_id, write_dir, processed_clauses)
+    generate_audio_files(api_key, voice_id, write_dir, processed_clauses, cache, max_workers, api_url=api_url)
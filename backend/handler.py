@@ -1,10 +1,5 @@
-import json
+from backend.service import create_app
 
 
-def hello(event, context):
-    body = {
-        "message": "Go Serverless v3.0! Your function executed successfully!",
-        "input": event,
-    }
-
-    return {"statusCode": 200, "body": json.dumps(body)}
+# Served with an ASGI server, e.g. `uvicorn backend.handler:app`
+app = create_app()
@@ -0,0 +1,116 @@
+import wave
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from backend.audio_buffer import INT16_SCALE, SampleBuffer
+
+
+class ClauseLoudness:
+    """Windowed RMS measurements over a whole clause from a single pass over its samples.
+
+    The squared samples are accumulated into a prefix sum once, after which the energy of
+    any window is the difference of two entries, so measuring thousands of overlapping
+    windows costs one vectorized subtraction instead of a Python loop per window.
+
+    :param buffer: The clause audio.
+    """
+    def __init__(self, buffer: SampleBuffer):
+        self.sample_rate = buffer.sample_rate
+        self.channels = buffer.channels
+        self.num_samples = buffer.samples.shape[0]
+        energy = np.square(buffer.samples, dtype=np.float64).sum(axis=1)
+        self.cumulative_energy = np.concatenate(([0.0], np.cumsum(energy)))
+
+    def ms_to_samples(self, ms):
+        return (np.asarray(ms) * self.sample_rate / 1000).astype(np.int64)
+
+    def rms(self, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """The RMS amplitude of every [start, end) sample window, matching pydub's `rms`."""
+        start = np.clip(start, 0, self.num_samples)
+        end = np.clip(end, start, self.num_samples)
+        count = np.maximum((end - start) * self.channels, 1)
+        return np.sqrt((self.cumulative_energy[end] - self.cumulative_energy[start]) / count)
+
+    def dbfs(self, start: int, end: int) -> float:
+        """The loudness of the [start, end) sample window, matching pydub's `dBFS`."""
+        rms = self.rms(np.array([start]), np.array([end]))[0]
+        return 20 * np.log10(rms / INT16_SCALE) if rms else -float("inf")
+
+    def nonsilent_bounds(
+        self,
+        windows_ms: list[tuple[int, int]],
+        min_silence_ms: int,
+        silence_thresh: float,
+    ) -> list[Optional[tuple[int, int]]]:
+        """Find the first nonsilent range of every window, in milliseconds relative to the window.
+
+        Mirrors `pydub.silence.detect_nonsilent(...)[0]` with a 1ms seek step, including
+        merging silent stretches closer together than `min_silence_ms`.  Windows that are
+        entirely silent get None.
+
+        :param windows_ms: (start, end) of each fragment within the clause, in milliseconds.
+        :param min_silence_ms: The shortest stretch of audio counted as silence.
+        :param silence_thresh: The level in dBFS under which audio is considered silent.
+        """
+        thresh = 10 ** (silence_thresh / 20) * INT16_SCALE
+        bounds: list[Optional[tuple[int, int]]] = []
+        for window_start, window_end in windows_ms:
+            offset = self.ms_to_samples(window_start)
+            window_samples = min(self.ms_to_samples(window_end), self.num_samples) - offset
+            length_ms = round(1000 * max(0, window_samples) / self.sample_rate)
+            if length_ms < min_silence_ms:
+                bounds.append((0, length_ms))
+                continue
+
+            starts_ms = np.arange(length_ms - min_silence_ms + 1)
+            starts = offset + np.minimum(self.ms_to_samples(starts_ms), window_samples)
+            ends = offset + np.minimum(self.ms_to_samples(starts_ms + min_silence_ms), window_samples)
+            # pydub compares the integer RMS that audioop returns
+            silence_starts = starts_ms[np.floor(self.rms(starts, ends)) <= thresh]
+            if not silence_starts.size:
+                bounds.append((0, length_ms))
+                continue
+
+            # A new silent range begins wherever the next silent window doesn't overlap the last
+            breaks = np.flatnonzero(np.diff(silence_starts) > min_silence_ms)
+            range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+            range_ends = silence_starts[np.concatenate((breaks, [-1]))] + min_silence_ms
+
+            if range_starts[0] > 0:
+                bounds.append((0, int(range_starts[0])))
+            elif len(range_starts) > 1:
+                bounds.append((int(range_ends[0]), int(range_starts[1])))
+            elif range_ends[0] < length_ms:
+                bounds.append((int(range_ends[0]), length_ms))
+            else:
+                bounds.append(None)
+        return bounds
+
+def rms_envelope(path: Union[str, Path], rate: float, block_seconds: float=60) -> np.ndarray:
+    """The RMS amplitude of a 16-bit WAV file over consecutive windows of 1/`rate` seconds.
+
+    The file is read `block_seconds` at a time and each block is reduced to its windows
+    in one vectorized pass, so long sessions aren't loaded into memory at once.
+
+    :param path: The WAV file.
+    :param rate: The number of windows per second, e.g. a video's frame rate.
+    :param block_seconds: The length of audio read at a time.
+    :return: The RMS of each window, in the range [0, 1].
+    """
+    with wave.open(str(path), "rb") as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise Exception(f"{path} isn't 16-bit audio")
+        sample_rate, channels, num_samples = wav_file.getframerate(), wav_file.getnchannels(), wav_file.getnframes()
+        num_windows = int(np.ceil(num_samples * rate / sample_rate))
+        edges = np.minimum((np.arange(num_windows + 1) * sample_rate / rate).astype(np.int64), num_samples)
+        envelope = np.empty(num_windows)
+        block_windows = max(1, int(block_seconds * rate))
+        for start in range(0, num_windows, block_windows):
+            stop = min(start + block_windows, num_windows)
+            pcm = np.frombuffer(wav_file.readframes(edges[stop] - edges[start]), dtype=np.int16)
+            energy = np.square(pcm / INT16_SCALE).reshape(-1, channels).mean(axis=1)
+            window_energy = np.add.reduceat(energy, edges[start:stop] - edges[start])
+            envelope[start:stop] = np.sqrt(window_energy / np.diff(edges[start:stop + 1]))
+    return envelope
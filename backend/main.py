@@ -1,144 +1,364 @@
+import hashlib
+import json
+import logging
+import resource
 import webbrowser
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from dataclasses import asdict
 from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
 
+import click
 from jinja2 import Environment, FileSystemLoader
-from pydub import AudioSegment # type: ignore
 from dotenv import load_dotenv # type: ignore
 
-from backend.schemas import Clause, Section, Script, Fragment
-from backend.common import find_files_in_directory
+from backend.alignment import AlignedFragment, align_clauses
+from backend.audio_buffer import StreamingWavWriter
+from backend.schemas import Clause, Section, Script, Fragment, FragmentBase, ProcessedAudio
+from backend.common import bounded_map
 from backend.fetch_audio import fetch
-from backend.process_audio import align_clause, process_fragments
+from backend.numpy_generate_blobs import BlobSettings, audio_time_scales, write_video
+from backend.pcm_store import PcmStore
+from backend.profiling import ProfileData, profiler
+from backend.process_audio import PaddedFragment, get_tokenizer
+from backend.render_graph import ArtifactStore, ClausePlan, RenderPlan, render_clause_stages
+from backend.script_catalog import ScriptCatalog
+from backend.time_stretch import TimeStretcher, get_stretcher
+from backend.timing import SessionSchedule
 
-jinja = Environment(loader=FileSystemLoader("."))
+jinja = Environment(loader=FileSystemLoader([".", Path(__file__).parent / "templates"]))
 
-def generate_report(rendered_sections: list[Section], output_dir: Path):
-    output_dir.mkdir(parents=True, exist_ok=True)
+VOICE_NAME = "Sleepy Sister"
+RENDER_PARAMS = dict(
+    extend_silence_ms=500, 
+    min_silence_ms=250, 
+    noise_scale=100, 
+    target_speech_rate=3.5,
+    shift_fragment_windows=-50,
+    target_dbfs=-20,
+)
+# Clauses to align, by name in the `PcmStore` holding their audio
+ClauseAudio = tuple[str, Clause]
+ClauseTask = tuple[ClausePlan, ArtifactStore, PcmStore, Optional[list[AlignedFragment]], list[PaddedFragment]]
+ProgressCallback = Callable[[str, dict[str, Any]], None]
+# Threads exporting report audio, each with at most two clauses waiting on it
+EXPORT_WORKERS = 4
+
+# Per-process rendering state, set up by `init_render_worker`
+stretcher: Optional[TimeStretcher] = None
+
+def init_render_worker():
+    """Set up the state clause rendering needs once per process instead of once per clause."""
+    global stretcher
+    stretcher = get_stretcher()
+    get_tokenizer()
+
+def init_render_process():
+    # Forked workers start with a copy of the main process's measurements, which it already has
+    profiler.reset()
+    init_render_worker()
+
+def align_section(task: tuple[PcmStore, list[ClauseAudio]]) -> tuple[list[list[AlignedFragment]], ProfileData]:
+    pcm, section = task
+    alignments = align_clauses([(pcm.get(name), clause) for name, clause in section])
+    return alignments, profiler.drain()
+
+def render_clause(task: ClauseTask) -> tuple[list[tuple[int, FragmentBase]], ProfileData]:
+    """Run the trim, retime and pad stages of a single clause.
+
+    Runs in a worker process when rendering in parallel.  The clause audio is mapped
+    from the `PcmStore` in the worker and only picklable sample buffers are returned,
+    not AudioSegments, along with the worker's measurements of the stages.
+    """
+    clause_plan, store, pcm, alignment, padding = task
+    audio = pcm.get(clause_plan.name) if clause_plan.name in pcm else None
+    fragments = render_clause_stages(clause_plan, store, RENDER_PARAMS, audio, alignment, stretcher, padding)
+    return fragments, profiler.drain()
+
+def render_sections(plan: RenderPlan, schedule: SessionSchedule, pcm: PcmStore, jobs: int=1) -> Iterator[list[tuple[int, FragmentBase]]]:
+    """Align and render every clause across `jobs` processes, skipping stages that are up to date.
 
+    The audio of clauses whose trim stage is stale is decoded into `pcm` up front, and
+    those missing an alignment are aligned in a single batch per section.  Rendered
+    clauses are yielded in script order as soon as they're ready, with at most two per
+    worker in flight so memory doesn't grow with the length of the script.
+    """
+    if jobs <= 1:
+        init_render_worker()
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_render_process)
+    try:
+        pcm.add({clause.name: clause.audio_path for clause in plan.clauses if not plan.is_fresh(clause.nodes["trim"])})
+        unaligned = [
+            [
+                clause for clause in section 
+                if not plan.is_fresh(clause.nodes["trim"]) and not plan.is_fresh(clause.nodes["align"])
+            ]
+            for section in plan.sections
+        ]
+        unaligned = [section for section in unaligned if section]
+        batches = [(pcm, [(clause.name, clause.clause) for clause in section]) for section in unaligned]
+        alignments = {}
+        for section, (section_alignments, profile) in zip(unaligned, bounded_map(executor, align_section, batches, jobs)):
+            profiler.merge(profile)
+            for clause, alignment in zip(section, section_alignments):
+                plan.store.save(clause.nodes["align"], alignment)
+                alignments[clause.name] = alignment
+
+        tasks = (
+            (clause, plan.store, pcm, alignments.get(clause.name), schedule.clause_padding(clause.first_fragment, len(clause.clause.fragments)))
+            for clause in plan.clauses
+        )
+        for fragments, profile in bounded_map(executor, render_clause, tasks, 2 * jobs):
+            profiler.merge(profile)
+            yield fragments
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+def export_clause_audio(section_idx: int, clause_idx: int, clause: Clause, output_dir: Path):
+    """Export the audio of all the clause's fragments for the report into a single file.
+
+    Every fragment's raw, nonsilent, processed and extended audio is written back to back
+    into one WAV per clause, and the fragments' audio buffers are replaced by media
+    fragment URLs (`file.wav#t=start,end`) pointing at their range of it.  That's one
+    export per clause instead of four per fragment, and the audio can be freed as soon
+    as the clause is written.
+    """
     segments_dir = output_dir / "segments"
-    segments_dir.mkdir(exist_ok=True)
-
-    html_parts = []
-
-    for section_idx, section in enumerate(rendered_sections):
-        html_parts.append(f'<h2>Section: {section.name}</h2>')
-
-        for clause_idx, clause in enumerate(section.clauses):
-            html_parts.append(f'<h3>Clause {clause_idx + 1}: {clause.text}</h3>')
-            table_rows = []
-
-            for fragment_idx, fragment in enumerate(clause.fragments):
-                audio_files = {}
-                fragment_audio = fragment.processed_audio.__dict__.items()
-                for audio_type, audio in fragment_audio:
-                    audio_file = segments_dir / f"{section_idx}_{clause_idx}_{fragment_idx}_{audio_type}.wav"
-                    audio.export(audio_file, format="wav")
-                    audio_files[audio_type] = audio_file.relative_to(output_dir)
-
-                fragment_table_row = (
-                    [
-                        f'<td>{fragment.text}</td>'
-                    ] +
-                    [
-                        f"""
-                            <td>
-                                <button onclick="playPause(this);" class="play-pause-btn">
-                                    <i class="fas fa-play"></i>
-                                </button>
-                                <audio id="audio-{section_idx}-{clause_idx}-{fragment_idx}-{audio_type}" onended="resetButton(this);">
-                                    <source src="{value}" type="audio/wav">
-                                </audio>
-                            </td>
-
-                        """
-                        for value in audio_files.values()
-                    ] +
-                    [
-                        f"<td>{format(value, '.4f') if isinstance(value, float) else value}</td>"
-                        for key, value in fragment.report.__dict__.items()
-                    ]
-                )
-
-                table_rows.append('<tr>' + ''.join(fragment_table_row) + '</tr>')
-
-            html_parts.append(f"""
-                <table class="styled-table">
-                    <tr>
-                        <th>Text</th>
-
-                        <th>Raw Audio</th>
-                        <th>Nonsilent Audio</th>
-                        <th>Processed Audio</th>
-                        <th>Extended Audio</th>
-
-                        <th>Speech Rate</th>
-                        <th>Retime %</th>
-                        <th>Noise Factor</th>
-                        <th>Raw Length</th>
-                        <th>Non-silent Length</th>
-                        <th>Silent Length</th>
-                        <th>Extended Length</th>
-                        <th>Random Silence Duration</th>
-                    </tr>
-                    {"".join(table_rows)}
-                </table>
-            """)
-    # Render HTML report using Jinja2
-    template = jinja.get_template("report_template.html")
-    html_content = template.render(html_content="\n".join(html_parts))
-
-    report_file_path = output_dir / "report.html"
-    with open(report_file_path, "w") as report_file:
-        report_file.write(html_content)
-
-    # Open the report in the default web browser
-    webbrowser.open(str(report_file_path))
-
-def main():
-    load_dotenv("../.env")
+    segments_dir.mkdir(parents=True, exist_ok=True)
+    clause_file = segments_dir / f"{section_idx}_{clause_idx}.wav"
+    source = clause_file.relative_to(output_dir)
+
+    with profiler.stage("export", clause=str(source)):
+        with StreamingWavWriter(clause_file) as writer:
+            for fragment in clause.fragments:
+                audio_ranges = {}
+                for audio_type, audio in fragment.processed_audio.__dict__.items():
+                    start = writer.frames_written / audio.sample_rate
+                    writer.write(audio)
+                    end = writer.frames_written / audio.sample_rate
+                    audio_ranges[audio_type] = f"{source}#t={start:.3f},{end:.3f}"
+                fragment.processed_audio = ProcessedAudio(**audio_ranges)
+        profiler.count("export", bytes=clause_file.stat().st_size)
+
+def generate_report(rendered_sections: list[Section], output_dir: Path, open_browser: bool=True):
+    """Write the report for the rendered sections, whose audio was exported by `export_clause_audio`."""
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    for script_file in find_files_in_directory("scripts", "\.json"):
-        with open(script_file, "r") as script_file:
-            script = Script.from_json(script_file.read())
-        
+    with profiler.stage("report"):
+        # Render HTML report using Jinja2
+        sections_html = jinja.get_template("report_sections.html").render(sections=rendered_sections)
+        template = jinja.get_template("report_template.html")
+        html_content = template.render(html_content=sections_html)
 
-        audio_dir = Path("audio", script.name)
-        raw_dir = audio_dir / "raw"
-        fetch("Sleepy Sister", script, raw_dir)
+        report_file_path = output_dir / "report.html"
+        with open(report_file_path, "w") as report_file:
+            report_file.write(html_content)
+        profiler.count("report", bytes=len(html_content))
 
-        output = AudioSegment.empty()
+    if open_browser:
+        # Open the report in the default web browser
+        webbrowser.open(str(report_file_path))
+
+def render_background_video(audio_dir: Path, fps: int, jobs: int=1):
+    """Render a blob video as long as the script's output, with its motion following the output's loudness."""
+    with profiler.stage("video"):
+        time_scales = audio_time_scales(audio_dir / "output.wav", fps)
+        settings = BlobSettings(max_frames=len(time_scales), time_scales=time_scales)
+        write_video(settings, audio_dir / "background.mp4", fps, workers=jobs)
+
+def render_script(
+    script: Script,
+    audio_root: Path=Path("audio"),
+    jobs: int=1,
+    stream_segments: int=0,
+    open_report: bool=False,
+    video_fps: int=0,
+    profile_format: str="json",
+    trace: bool=False,
+    archive: bool=False,
+    progress: Optional[ProgressCallback]=None,
+) -> Path:
+    """Render the script's audio, report and optionally a background video, skipping up to date stages.
+
+    :param script: The script to render.
+    :param audio_root: The directory holding a directory of output per script.
+    :param jobs: Number of processes rendering clauses in parallel.
+    :param stream_segments: Also write the output as HLS-style segments of this many seconds.
+    :param open_report: Open the report in a browser once it's written.
+    :param video_fps: Also render a background video at this frame rate.
+    :param profile_format: Format of the per-stage timings written next to the output, json or csv.
+    :param trace: Also write a Chrome trace of every stage run next to the output.
+    :param archive: Also keep FLAC copies of the clause audio in the script's archive directory.
+    :param progress: Called with the name of each finished step and details about it.
+
+    :return: The directory the script was rendered into.
+    """
+    notify = progress or (lambda step, details: None)
+    audio_dir = audio_root / script.name
+    raw_dir = audio_dir / "raw"
+    plan = RenderPlan(script, audio_dir, VOICE_NAME, RENDER_PARAMS, get_stretcher().name)
+    pcm = PcmStore(audio_dir / "pcm")
+
+    profiler.reset()
+    if not all(plan.is_fresh(clause.nodes["fetch"]) for clause in plan.clauses):
+        with profiler.stage("fetch"):
+            fetch(VOICE_NAME, script, raw_dir)
+    notify("fetch", {})
+
+    # Each clause is appended to the output as soon as it's rendered and its audio is
+    #   exported for the report, so only the clauses in flight are held in memory
+    write_output = not plan.is_fresh(plan.concatenate)
+    write_report = not plan.is_fresh(plan.report)
+    if not write_output and not write_report:
+        print(f"{script.name} is up to date")
+    else:
+        # The padding of the whole script is planned before any clause is rendered
+        schedule = plan.load_schedule()
+        schedule.save(audio_dir / "schedule.json", script, RENDER_PARAMS["target_speech_rate"])
+        rendered = render_sections(plan, schedule, pcm, jobs)
         report = []
-        for section_ix, section in enumerate(script.sections):
-            rendered_section = Section(
-                name=section.name, 
-                audio=AudioSegment.empty(),
-                clauses=[]
-            )   
-            for clause_ix, clause in enumerate(section.clauses):
-                name = f"{section_ix}_{section.name}_{clause_ix}.wav"
-                fragments = process_fragments(
-                    AudioSegment.from_file(raw_dir / name), 
-                    align_clause(raw_dir / name, clause), 
-                    extend_silence_ms=500, 
-                    min_silence_ms=250, 
-                    noise_scale=100, 
-                    target_speech_rate=3.5,
-                    shift_fragment_windows=-50
-                )
-                all_segments = sum([s.audio.extended for s in fragments])
-                rendered_clause = Clause(
-                    audio=all_segments,
-                    fragments=fragments,
-                )  
-                rendered_section.audio += all_segments
-                rendered_section.clauses.append(rendered_clause)
-            output += rendered_section.audio
-            report.append(rendered_section)
-        output.export(audio_dir / "output.wav", format="wav")
-
-        report = generate_report(report, audio_dir)
+        # The rendered length of every fragment by its index in the script, to check the schedule's estimate
+        rendered_ms: dict[int, float] = {}
+        first_fragment = 0
+        exports: deque[Future] = deque()
+        rendered_count = 0
+        with ExitStack() as stack:
+            # Report audio is exported on threads while the next clauses render
+            exporter = stack.enter_context(ThreadPoolExecutor(max_workers=EXPORT_WORKERS))
+            writer = stack.enter_context(StreamingWavWriter(
+                audio_dir / "output.wav", 
+                audio_dir / "stream" if stream_segments else None, 
+                stream_segments
+            )) if write_output else None
+            for section_ix, section in enumerate(script.sections):
+                rendered_section = Section(
+                    id=section.id,
+                    name=section.name, 
+                    audio=None,
+                    clauses=[]
+                )   
+                for clause_ix, clause in enumerate(section.clauses):
+                    fragments = next(rendered)
+                    for idx, fragment in fragments:
+                        extended = fragment.processed_audio.extended
+                        rendered_ms[first_fragment + idx] = extended.frame_count / extended.sample_rate * 1000
+                    first_fragment += len(clause.fragments)
+                    if writer:
+                        with profiler.stage("concatenate"):
+                            for _, fragment in fragments:
+                                writer.write(fragment.processed_audio.extended)
+                                profiler.count("concatenate", bytes=fragment.processed_audio.extended.samples.nbytes)
+                    # Carry the ids over from the script by position, the aligned text can differ or repeat
+                    rendered_clause = Clause(
+                        id=clause.id,
+                        audio=None,
+                        fragments=[Fragment(id=clause.fragments[idx].id, **f.dict()) for idx, f in fragments],
+                    )  
+                    if write_report:
+                        # Drop finished exports and wait on the oldest before queueing another,
+                        #   so clauses waiting to be exported don't pile up in memory
+                        while exports and (exports[0].done() or len(exports) >= 2 * EXPORT_WORKERS):
+                            exports.popleft().result()
+                        exports.append(exporter.submit(export_clause_audio, section_ix, clause_ix, rendered_clause, audio_dir))
+                        rendered_section.clauses.append(rendered_clause)
+                    rendered_count += 1
+                    notify("clause", {"rendered": rendered_count, "total": len(plan.clauses)})
+                report.append(rendered_section)
+        rendered.close()
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Rendered {script.name}, peak RSS {peak_rss_mb:.1f}MB")
+        schedule.save(audio_dir / "schedule.json", script, RENDER_PARAMS["target_speech_rate"], rendered_ms)
+
+        if write_report:
+            while exports:
+                exports.popleft().result()
+            generate_report(report, audio_dir, open_browser=open_report)
+            notify("report", {})
+        plan.save_manifest()
+
+    if archive:
+        pcm.add({clause.name: clause.audio_path for clause in plan.clauses})
+        pcm.archive(audio_dir / "archive")
+        notify("archive", {})
+
+    if video_fps:
+        render_background_video(audio_dir, video_fps, jobs)
+        notify("video", {})
+
+    print("\n".join(profiler.format_summary()))
+    profiler.write_summary(audio_dir / f"profile.{profile_format}")
+    if trace:
+        profiler.write_trace(audio_dir / "trace.json")
+    return audio_dir
+
+@click.command()
+@click.option("--jobs", default=1, type=int, help="Number of processes rendering clauses in parallel")
+@click.option("--dry-run", is_flag=True, help="List the stages that would be recomputed and why, then exit")
+@click.option("--stream-segments", default=0, type=int, help="Also write the output as HLS-style segments of this many seconds")
+@click.option("--headless", is_flag=True, help="Don't open the report in a browser")
+@click.option("--video-fps", default=0, type=int, help="Also render a background video following the loudness of the output at this frame rate")
+@click.option("--log-level", default="WARNING", type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]), help="Level of the messages logged")
+@click.option("--profile-format", default="json", type=click.Choice(["json", "csv"]), help="Format of the per-stage timings written next to the output")
+@click.option("--trace", is_flag=True, help="Also write a Chrome trace of every stage run next to the output")
+@click.option("--archive", is_flag=True, help="Also keep FLAC copies of the clause audio next to the output")
+@click.option("--force", is_flag=True, help="Render every script, including those unchanged since they were last rendered")
+def main(
+    jobs: int, 
+    dry_run: bool, 
+    stream_segments: int, 
+    headless: bool, 
+    video_fps: int, 
+    log_level: str, 
+    profile_format: str, 
+    trace: bool,
+    archive: bool,
+    force: bool,
+):
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_dotenv("../.env")
+
+    catalog = ScriptCatalog(Path("scripts"))
+    errors = catalog.scan()
+    for error in errors:
+        logging.error(error)
+
+    if dry_run:
+        for _, script in catalog.scripts():
+            plan = RenderPlan(script, Path("audio", script.name), VOICE_NAME, RENDER_PARAMS, get_stretcher().name)
+            print(f"Render plan for {script.name}:")
+            print("\n".join(plan.explain()))
+    else:
+        # Everything besides the script that decides whether a rendered script is stale
+        render_key = hashlib.sha256(json.dumps(
+            [VOICE_NAME, RENDER_PARAMS, get_stretcher().name, stream_segments, video_fps, archive], sort_keys=True
+        ).encode("utf-8")).hexdigest()
+        def is_rendered(script: Script) -> bool:
+            # The catalog's record is only trusted while the output and report are up to date
+            plan = RenderPlan(script, Path("audio", script.name), VOICE_NAME, RENDER_PARAMS, get_stretcher().name)
+            return plan.is_fresh(plan.concatenate) and plan.is_fresh(plan.report)
+
+        scripts = catalog.scripts() if force else catalog.pending(render_key, is_rendered)
+        for script_path, script in scripts:
+            render_script(
+                script, 
+                jobs=jobs, 
+                stream_segments=stream_segments, 
+                open_report=not headless, 
+                video_fps=video_fps, 
+                profile_format=profile_format, 
+                trace=trace,
+                archive=archive,
+            )
+            catalog.mark_rendered(script_path, render_key)
 
+    if errors:
+        # The valid scripts were still rendered, only the exit status reports the invalid ones
+        raise click.ClickException(f"{len(errors)} errors in the scripts, see the log above")
 
 if __name__ == "__main__":
     main()
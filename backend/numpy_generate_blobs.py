@@ -1,19 +1,31 @@
-from typing import Any
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable, Optional
 
 import click
 import numpy as np
 import numpy.typing as npt
 import cv2 # type: ignore
 import webcolors # type: ignore
-from scipy.interpolate import RectBivariateSpline # type: ignore
 
-from backend.common import rescaled_noise
+from backend.common import CACHE_DIR, bounded_map, rescaled_noise
+from backend.loudness import rms_envelope
+from backend.simplex_noise import rescaled_noise_grid
+
+logger = logging.getLogger(__name__)
 
 Color = list[tuple[int, int, int]]
 WeightedColor = list[tuple[Color, float]]
 
+DEFAULT_COLORS = "#E3D2B5:2,#F2B950:5,#D99748:3,#D99AB7:5,#D98989:2"
+
 
-def process_colors(colors: str) -> tuple[npt.NDArray, npt.NDArray]:
+def process_colors(colors: str, bgr: bool=False) -> tuple[npt.NDArray, npt.NDArray]:
     """
     Parses a string representation of colors and weights and returns
     arrays of colors and cumulative weights.
@@ -21,9 +33,10 @@ def process_colors(colors: str) -> tuple[npt.NDArray, npt.NDArray]:
     Args:
         colors: A string of hex values and their corresponding weights,
                 separated by commas and colons, e.g. "#D99AB7:0.2,#F2B950:0.3,#E3D2B5:0.5"
+        bgr: Return the colors in BGR order, as OpenCV expects frames, instead of RGB
     
     Returns:
-        color_array: An ndarray of shape (num_colors, 3) containing RGB colors
+        color_array: An ndarray of shape (num_colors, 3) containing RGB (or BGR) colors
         cumulative_weights: An ndarray of shape (num_colors + 1,) containing the cumulative weights
     """
     # Parse the input string and create a list of colors and weights
@@ -31,6 +44,8 @@ def process_colors(colors: str) -> tuple[npt.NDArray, npt.NDArray]:
     # Separate the colors and weights into two separate lists
     color_list, weights = zip(*parsed)
     color_array = np.array([webcolors.hex_to_rgb(c) for c in color_list], dtype=webcolors.IntegerRGB)
+    if bgr:
+        color_array = np.ascontiguousarray(color_array[:, ::-1])
     weights_array = np.array(weights, dtype=np.float32)
     
     # Compute the cumulative sum of weights, ensuring the sum is 1
@@ -69,56 +84,360 @@ def noise_to_color_array(noise: np.ndarray, color_array: np.ndarray, cumulative_
     
     return result
 
-@click.command()
-@click.option("--width", default=640, type=int, help="Video width")
-@click.option("--height", default=480, type=int, help="Video height")
-@click.option("--fps", default=60, type=int, help="Frames per second")
-@click.option("--duration", default=10, type=int, help="Video duration in seconds")
-@click.option("--noise_size_scale", default=0.0022, type=float, help="Scaling factor to determine the size (freqency) of the noise")
-@click.option("--noise_time_scale", default=0.1, type=float, help="Scaling factor to determine how quickly we move through the noise space")
-@click.option("--colors", default="#E3D2B5:2,#F2B950:5,#D99748:3,#D99AB7:5,#D98989:2", type=str, help="JSON list of CSS3 color names and weights")
-@click.option("--scale-factor", default=1, type=int, help="Factor to scale the output by")
-def main(width: int, height: int, fps: int, duration: int, noise_size_scale: float, noise_time_scale: float, colors: str, scale_factor: int) -> None:
-    max_frames = fps * duration
-    color_array, cumulative_weights = process_colors(colors)
 
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter('perlin_noise_color_space.mp4', fourcc, fps, (width, height), True)
+class PaletteLUT:
+    """
+    Maps noise values to colors through a table of `noise_to_color_array` sampled at
+    `size` evenly spaced noise values, so colorizing a frame is a single lookup instead
+    of comparing every pixel against every weight.
+    
+    Each frame is mapped into the same output buffer, so the returned frame is overwritten
+    by the next call.  The table is grown past `size` for palettes with steep gradients so
+    neighbouring entries are at most a value apart, keeping the colors within one value of
+    `noise_to_color_array`, up to `MAX_SIZE_FACTOR` times `size`.  Bands of lightly
+    weighted colors too narrow for that snap to their nearest entry.
+    
+    Args:
+        color_array: An ndarray of shape (num_colors, 3) containing colors, from `process_colors`
+        cumulative_weights: An ndarray of shape (num_colors + 1,) containing the cumulative weights
+        size: The minimum number of entries in the table
+    """
+    MAX_SIZE_FACTOR = 16
 
-    x_coords, y_coords = np.meshgrid(np.arange(width // scale_factor), np.arange(height // scale_factor))
-    vectorized_noise = np.vectorize(rescaled_noise)
+    def __init__(self, color_array: np.ndarray, cumulative_weights: np.ndarray, size: int=4096):
+        # The steepest change in color per unit of noise across the palette's intervals
+        color_steps = np.abs(np.diff(np.vstack((color_array, color_array[:1])).astype(np.float64), axis=0))
+        widths = np.diff(cumulative_weights)
+        # Zero weight colors take up no noise values, so they have no slope to keep up with
+        slopes = color_steps.max(axis=1)[widths > 0] / widths[widths > 0]
+        max_slope = slopes.max() if len(slopes) else 0.0
+        self.size = int(min(max(size, np.ceil(max_slope)), self.MAX_SIZE_FACTOR * size))
+        # Entries are sampled at the middle of the range of noise values that map to them
+        self.table = noise_to_color_array((np.arange(self.size) + 0.5) / self.size, color_array, cumulative_weights)
+        self.scaled: npt.NDArray = np.empty(0)
+        self.indices = np.empty(0, dtype=np.intp)
+        self.frame = np.empty((0, 3), dtype=np.uint8)
 
-    for t in range(max_frames):
-        print(t)
-        small_frame = np.zeros((height // scale_factor, width // scale_factor, 3), dtype=np.uint8)
+    def __call__(self, noise: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            noise: An ndarray of shape (height, width) containing noise values in the range [0, 1]
+        
+        Returns:
+            result: An ndarray of shape (height, width, 3) containing the noise values mapped to colors
+        """
+        if self.scaled.shape != noise.shape or self.scaled.dtype != noise.dtype:
+            self.scaled = np.empty_like(noise)
+            self.indices = np.empty(noise.shape, dtype=np.intp)
+            self.frame = np.empty((*noise.shape, 3), dtype=np.uint8)
+        np.multiply(noise, self.size, out=self.scaled)
+        np.copyto(self.indices, self.scaled, casting="unsafe")
+        np.clip(self.indices, 0, self.size - 1, out=self.indices)
+        return np.take(self.table, self.indices, axis=0, out=self.frame)
 
-        # Calculate noisey_t_x and noisey_t_y for circular traversal
-        angle = np.pi * (t / max_frames)
+
+class BilinearUpscaler:
+    """
+    Upscales frames with bilinear interpolation, sampling the small frame at `np.linspace`
+    positions so the corners line up exactly like evaluating a linear `RectBivariateSpline`.
+    
+    The source position of every output pixel only depends on the frame sizes, so the
+    maps are computed once in OpenCV's fixed point format and each frame is a single
+    `cv2.remap` into the same output buffer, so the returned frame is overwritten by the
+    next call.  The fixed point weights put pixels within a few values of the spline's.
+    
+    Args:
+        small_shape: The (height, width) of the frames being upscaled
+        shape: The (height, width) of the upscaled frames
+    """
+    def __init__(self, small_shape: tuple[int, int], shape: tuple[int, int]):
+        self.identity = small_shape == shape
+        x_map, y_map = np.meshgrid(
+            np.linspace(0, small_shape[1] - 1, shape[1], dtype=np.float32),
+            np.linspace(0, small_shape[0] - 1, shape[0], dtype=np.float32),
+        )
+        self.maps = cv2.convertMaps(x_map, y_map, cv2.CV_16SC2)
+        self.frame = np.empty((shape[0], shape[1], 3), dtype=np.uint8)
+
+    def __call__(self, small_frame: npt.NDArray) -> npt.NDArray:
+        if self.identity:
+            return small_frame
+        return cv2.remap(small_frame, *self.maps, cv2.INTER_LINEAR, dst=self.frame, borderMode=cv2.BORDER_REPLICATE)
+
+@dataclass
+class BlobSettings:
+    """Everything that determines the frames of a blob video."""
+    max_frames: int
+    width: int = 640
+    height: int = 480
+    noise_size_scale: float = 0.0022
+    noise_time_scale: float = 0.1
+    colors: str = DEFAULT_COLORS
+    scale_factor: int = 1
+    dtype: Any = np.float64
+    chunk_size: Optional[int] = None
+    # Frames in one period of a seamless loop, frames don't repeat when not set
+    loop_frames: Optional[int] = None
+    # How fast each frame drifts, relative to noise_time_scale's speed, see `audio_time_scales`
+    time_scales: Optional[npt.NDArray] = None
+
+    def loop_key(self) -> str:
+        """Hash of the settings that determine the frames of a loop, the chunk size and output length don't."""
+        key = (
+            f"{self.width}:{self.height}:{self.loop_frames}:{self.noise_size_scale}:{self.noise_time_scale}"
+            f":{self.colors}:{self.scale_factor}:{np.dtype(self.dtype).name}"
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+class FrameRenderer:
+    """
+    Renders the frame at any time step of a blob video.  Each frame only depends on its
+    time step, so frames can be rendered in any order and in any process.
+    
+    The returned frame is a buffer that's overwritten by the next call.
+    """
+    def __init__(self, settings: BlobSettings):
+        self.settings = settings
+        small_shape = (settings.height // settings.scale_factor, settings.width // settings.scale_factor)
+        # The palette is in BGR order so frames come out ready for the video writer
+        color_array, cumulative_weights = process_colors(settings.colors, bgr=True)
+        self.colorize = PaletteLUT(color_array, cumulative_weights)
+        self.upscale = BilinearUpscaler(small_shape, (settings.height, settings.width))
+        self.x_coords, self.y_coords = np.meshgrid(
+            np.arange(small_shape[1], dtype=settings.dtype), 
+            np.arange(small_shape[0], dtype=settings.dtype),
+        )
+        # With per-frame time scales the field drifts along the same circle at a varying
+        #   speed, each frame stepping as far as its time scale allows, so the motion
+        #   speeds up and slows down without jumping
+        self.angles: Optional[npt.NDArray] = None
+        if settings.time_scales is not None:
+            steps = np.pi / settings.max_frames * (settings.time_scales / settings.noise_time_scale)
+            self.angles = np.concatenate([[0.0], np.cumsum(steps)[:-1]])
+
+    def __call__(self, t: int) -> npt.NDArray:
+        return self.upscale(self.render_small(t))
+
+    def render_small(self, t: int) -> npt.NDArray:
+        """Render the frame at time step `t` before it's upscaled."""
+        width, height = self.settings.width, self.settings.height
+        noise_size_scale, noise_time_scale = self.settings.noise_size_scale, self.settings.noise_time_scale
+        # Calculate noisey_t_x and noisey_t_y for circular traversal, loops go around
+        #   the full circle so the last frame leads back into the first
+        if self.angles is not None:
+            angle = self.angles[t]
+        elif self.settings.loop_frames:
+            angle = 2 * np.pi * (t / self.settings.loop_frames)
+        else:
+            angle = np.pi * (t / self.settings.max_frames)
         tx = (width * np.sin(angle) * noise_time_scale)
         ty = (height * np.cos(angle) * noise_time_scale)
-        noisey_t_x = tx + vectorized_noise(tx, tx, noise_size_scale)
-        noisey_t_y = ty + vectorized_noise(ty*2, ty*2, noise_size_scale)
+        noisey_t_x = tx + rescaled_noise(tx, tx, noise_size_scale)
+        noisey_t_y = ty + rescaled_noise(ty*2, ty*2, noise_size_scale)
 
-        space_noise_1 = vectorized_noise(x_coords + noisey_t_x, y_coords + noisey_t_y, noise_size_scale)
-        space_noise_2 = vectorized_noise(x_coords - noisey_t_x, y_coords - noisey_t_y, noise_size_scale)
+        # The noise for every pixel is computed in a few array operations per frame
+        dtype, chunk_size = self.settings.dtype, self.settings.chunk_size
+        space_noise_1 = rescaled_noise_grid(self.x_coords + noisey_t_x, self.y_coords + noisey_t_y, noise_size_scale, dtype, chunk_size)
+        space_noise_2 = rescaled_noise_grid(self.x_coords - noisey_t_x, self.y_coords - noisey_t_y, noise_size_scale, dtype, chunk_size)
 
         combined_noise = (space_noise_1 + space_noise_2 ) % 1
 
-        small_frame = noise_to_color_array(combined_noise, color_array, cumulative_weights)
-        
-        # Upscale the small frame using linear interpolation
-        x = np.arange(width // scale_factor)
-        y = np.arange(height // scale_factor)
-        x_new = np.linspace(0, width // scale_factor - 1, width)
-        y_new = np.linspace(0, height // scale_factor - 1, height)
-        frame = np.zeros((height, width, 3), dtype=np.uint8)
-        for i in range(3):
-            interpolator = RectBivariateSpline(y, x, small_frame[..., i], kx=1, ky=1)
-            frame[..., i] = interpolator(y_new, x_new)
-        
-        frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)  # Convert the frame from RGB
-        video_writer.write(frame_bgr)
-    video_writer.release()
+        return self.colorize(combined_noise)
+
+# Per-process frame rendering state, set up by `init_frame_worker`
+renderer: Optional[FrameRenderer] = None
+
+def init_frame_worker(settings: BlobSettings):
+    global renderer
+    renderer = FrameRenderer(settings)
+
+def render_frame(t: int) -> npt.NDArray:
+    assert renderer
+    return renderer(t)
+
+def render_small_frame(t: int) -> npt.NDArray:
+    assert renderer
+    return renderer.render_small(t)
+
+def render_frames(
+    settings: BlobSettings, 
+    workers: int=1, 
+    max_in_flight: int=0, 
+    frame_count: Optional[int]=None, 
+    upscaled: bool=True,
+) -> Iterable[npt.NDArray]:
+    """
+    Renders the first `frame_count` frames of the video in order, every frame by default.
+    Frames are returned before they're upscaled when `upscaled` is false.
+    
+    With more than one worker, frames are rendered in a process pool with at most
+    `max_in_flight` frames submitted and not yet consumed, which bounds the memory held by
+    frames that finished out of order.  Otherwise they're rendered in this process, and
+    each frame is overwritten by the next one.
+    """
+    time_steps = range(settings.max_frames if frame_count is None else frame_count)
+    if workers <= 1:
+        frame_renderer = FrameRenderer(settings)
+        yield from map(frame_renderer if upscaled else frame_renderer.render_small, time_steps)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_frame_worker, initargs=(settings,)) as executor:
+        fn = render_frame if upscaled else render_small_frame
+        yield from bounded_map(executor, fn, time_steps, max_in_flight or 2 * workers)
+
+def load_loop(settings: BlobSettings, workers: int=1, max_in_flight: int=0, cache_dir: Path=CACHE_DIR / "blobs") -> npt.NDArray:
+    """
+    Returns the frames of one period of a seamless loop, before they're upscaled, as a
+    read-only memory mapped array of shape (loop_frames, height, width, 3).
+    
+    The loop is rendered once for its settings and cached, later videos with the same
+    settings of any length just read the frames back and upscale them.
+    """
+    assert settings.loop_frames
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / f"{settings.loop_key()}.npy"
+    if not path.exists():
+        # Rendered into a temp file so an interrupted render isn't mistaken for a loop
+        tmp_path = cache_dir / f".{path.stem}.{os.getpid()}.npy"
+        shape = (settings.loop_frames, settings.height // settings.scale_factor, settings.width // settings.scale_factor, 3)
+        frames = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+        for t, frame in enumerate(render_frames(settings, workers, max_in_flight, settings.loop_frames, upscaled=False)):
+            frames[t] = frame
+        frames.flush()
+        del frames
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+def audio_time_scales(
+    audio_path: Path, 
+    fps: int, 
+    noise_time_scale: float=0.1, 
+    reactivity: float=0.5, 
+    smoothing_seconds: float=1.0,
+) -> npt.NDArray:
+    """
+    Computes a noise_time_scale for every video frame from the loudness of the audio, so
+    the blobs drift faster while there's speech and slow down during silences.
+    
+    Args:
+        audio_path: The rendered session, e.g. output.wav
+        fps: Frames per second of the video
+        noise_time_scale: The time scale at average loudness
+        reactivity: How far the time scale moves with the loudness, from 1 - reactivity
+                    times noise_time_scale in silence to 1 + reactivity at the loudest,
+                    which scales the drift speed by the same factor
+        smoothing_seconds: The length of the moving average applied to the loudness so
+                           the blobs don't jitter with every syllable
+    
+    Returns:
+        time_scales: An ndarray of shape (num_frames,), one frame for every 1/fps seconds of audio
+    """
+    envelope = rms_envelope(audio_path, fps)
+    window = max(1, int(smoothing_seconds * fps))
+    envelope = np.convolve(envelope, np.ones(window) / window, mode="same")
+    peak = envelope.max(initial=0)
+    if peak > 0:
+        envelope /= peak
+    return noise_time_scale * (1 + reactivity * (2 * envelope - 1))
+
+def write_video(
+    settings: BlobSettings, 
+    path: Optional[Path], 
+    fps: int, 
+    workers: int=1, 
+    max_in_flight: int=0,
+) -> None:
+    """
+    Renders the video and encodes it to `path`, or only renders it without a path.
+    
+    Args:
+        settings: The settings of the video
+        path: The mp4 file written
+        fps: Frames per second of the video
+        workers: Number of processes rendering frames, frames are encoded on a separate thread when more than 1
+        max_in_flight: Number of frames being rendered or waiting to be encoded at once, defaults to twice the workers
+    """
+    max_in_flight = max_in_flight or 2 * workers
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_writer = cv2.VideoWriter(str(path), fourcc, fps, (settings.width, settings.height), True) if path else None
+
+    start = time.perf_counter()
+    if settings.loop_frames:
+        # Every frame is streamed from the cached loop, only upscaling is left to do
+        loop = load_loop(settings, workers, max_in_flight)
+        upscale = BilinearUpscaler(loop.shape[1:3], (settings.height, settings.width))
+        frames = (upscale(loop[t % len(loop)]) for t in range(settings.max_frames))
+    else:
+        frames = render_frames(settings, workers, max_in_flight)
+    # Streamed loop frames share the upscaler's buffer, so they're written as they're made
+    if video_writer and workers > 1 and not settings.loop_frames:
+        # Frames are encoded on their own thread while the workers render the next ones
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            for t, _ in enumerate(bounded_map(encoder, video_writer.write, frames, max_in_flight)):
+                logger.debug(f"encoded frame {t}")
+    else:
+        for t, frame in enumerate(frames):
+            if video_writer:
+                video_writer.write(frame)
+                logger.debug(f"encoded frame {t}")
+    if video_writer:
+        video_writer.release()
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {settings.max_frames} frames in {elapsed:.2f}s, {settings.max_frames / elapsed:.1f} frames per second")
+
+@click.command()
+@click.option("--width", default=640, type=int, help="Video width")
+@click.option("--height", default=480, type=int, help="Video height")
+@click.option("--fps", default=60, type=int, help="Frames per second")
+@click.option("--duration", default=10, type=int, help="Video duration in seconds")
+@click.option("--noise_size_scale", default=0.0022, type=float, help="Scaling factor to determine the size (freqency) of the noise")
+@click.option("--noise_time_scale", default=0.1, type=float, help="Scaling factor to determine how quickly we move through the noise space")
+@click.option("--colors", default=DEFAULT_COLORS, type=str, help="JSON list of CSS3 color names and weights")
+@click.option("--scale-factor", default=1, type=int, help="Factor to scale the output by")
+@click.option("--float32", "use_float32", is_flag=True, help="Compute the noise in float32, faster but further from the scalar noise")
+@click.option("--chunk-size", default=None, type=int, help="Number of pixels the noise is computed for at a time")
+@click.option("--benchmark", is_flag=True, help="Render the frames without writing a video and report frames per second")
+@click.option("--workers", default=1, type=int, help="Number of processes rendering frames, frames are encoded on a separate thread when more than 1")
+@click.option("--loop-seconds", default=0, type=int, help="Render a seamless loop of this many seconds once and repeat it for the duration")
+@click.option("--max-in-flight", default=0, type=int, help="Number of frames being rendered or waiting to be encoded at once, defaults to twice the workers")
+@click.option("--audio", default=None, type=click.Path(exists=True, path_type=Path), help="Rendered session (WAV) whose loudness drives the time scale, the video matches its length")
+@click.option("--reactivity", default=0.5, type=float, help="How strongly the audio's loudness modulates the time scale")
+def main(
+    width: int, 
+    height: int, 
+    fps: int, 
+    duration: int, 
+    noise_size_scale: float, 
+    noise_time_scale: float, 
+    colors: str, 
+    scale_factor: int, 
+    use_float32: bool, 
+    chunk_size: int, 
+    benchmark: bool,
+    workers: int,
+    loop_seconds: int,
+    max_in_flight: int,
+    audio: Optional[Path],
+    reactivity: float,
+) -> None:
+    if audio and loop_seconds:
+        raise Exception("Audio reactive videos can't loop")
+    time_scales = audio_time_scales(audio, fps, noise_time_scale, reactivity) if audio else None
+    settings = BlobSettings(
+        width=width, 
+        height=height, 
+        max_frames=len(time_scales) if time_scales is not None else fps * duration, 
+        noise_size_scale=noise_size_scale, 
+        noise_time_scale=noise_time_scale, 
+        colors=colors, 
+        scale_factor=scale_factor, 
+        dtype=np.float32 if use_float32 else np.float64, 
+        chunk_size=chunk_size,
+        loop_frames=fps * loop_seconds or None,
+        time_scales=time_scales,
+    )
+    write_video(settings, None if benchmark else Path('perlin_noise_color_space.mp4'), fps, workers, max_in_flight)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,142 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from backend.audio_buffer import SampleBuffer
+from backend.common import atomic_write
+from backend.profiling import profiler
+
+
+class PcmStore:
+    """Decoded clause audio kept in a single memory-mapped int16 file, sliced without copying.
+
+    Every clause is decoded once and appended to `samples.pcm`, with its offset, length
+    and format kept in an index.  `get` returns a buffer viewing the clause's range of
+    the mapped file, so trimming fragments out of it never copies or decodes anything,
+    and worker processes map the same pages instead of each decoding their own copy.
+    Entries remember the size and mtime of the file they were decoded from and are
+    decoded again when it changes, and the space of replaced entries is reclaimed once
+    it's more than the space in use.
+
+    :param root: The directory holding the samples and their index.
+    """
+    samples_name = "samples.pcm"
+    index_name = "index.json"
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index: dict[str, dict[str, Any]] = {}
+        self._samples: Optional[npt.NDArray[np.int16]] = None
+        index_path = self.root / self.index_name
+        if index_path.exists():
+            with open(index_path, "r") as index_file:
+                self.index = json.load(index_file)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Worker processes map the file themselves rather than receiving a copy of it
+        return {**self.__dict__, "_samples": None}
+
+    @property
+    def samples_path(self) -> Path:
+        return self.root / self.samples_name
+
+    @property
+    def live_bytes(self) -> int:
+        return sum(entry["frames"] * entry["channels"] * 2 for entry in self.index.values())
+
+    @staticmethod
+    def _stamp(source: Path) -> dict[str, int]:
+        stat = source.stat()
+        return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def is_current(self, name: str, source: Path) -> bool:
+        entry = self.index.get(name)
+        return entry is not None and all(entry[key] == value for key, value in self._stamp(source).items())
+
+    def add(self, sources: dict[str, Path]):
+        """Decode the `sources` that aren't already stored, keyed on their clause name."""
+        stale = {name: source for name, source in sources.items() if not self.is_current(name, source)}
+        if not stale:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._samples = None
+        with profiler.stage("decode"), open(self.samples_path, "ab") as samples_file:
+            offset = samples_file.tell() // 2
+            for name, source in stale.items():
+                buffer = SampleBuffer.from_file(source)
+                pcm = np.ascontiguousarray(buffer.to_pcm())
+                samples_file.write(pcm.tobytes())
+                self.index[name] = {
+                    "offset": offset,
+                    "frames": pcm.shape[0],
+                    "channels": buffer.channels,
+                    "sample_rate": buffer.sample_rate,
+                    **self._stamp(source),
+                }
+                offset += pcm.size
+                profiler.count("decode", bytes=pcm.nbytes, cache_misses=1)
+        if self.samples_path.stat().st_size > 2 * self.live_bytes:
+            self.compact()
+        else:
+            self._save_index()
+
+    def compact(self):
+        """Rewrite the samples file with only the entries in the index."""
+        samples = self._map()
+        compacted = self.root / f".{self.samples_name}.tmp"
+        index = {}
+        with open(compacted, "wb") as samples_file:
+            offset = 0
+            for name, entry in self.index.items():
+                size = entry["frames"] * entry["channels"]
+                samples_file.write(samples[entry["offset"]:entry["offset"] + size].tobytes())
+                index[name] = {**entry, "offset": offset}
+                offset += size
+        self._samples = None
+        del samples
+        os.replace(compacted, self.samples_path)
+        self.index = index
+        self._save_index()
+
+    def _save_index(self):
+        atomic_write(self.root / self.index_name, json.dumps(self.index, indent=2).encode("utf-8"))
+
+    def _map(self) -> npt.NDArray[np.int16]:
+        if self._samples is None:
+            if not self.samples_path.exists() or not self.samples_path.stat().st_size:
+                self._samples = np.zeros(0, dtype=np.int16)
+            else:
+                # A plain array view of the map, so slices pickle like any other samples
+                self._samples = np.memmap(self.samples_path, dtype=np.int16, mode="r").view(np.ndarray)
+        return self._samples
+
+    def get(self, name: str) -> SampleBuffer:
+        """The clause's audio as a read-only view of the mapped samples."""
+        entry = self.index[name]
+        size = entry["frames"] * entry["channels"]
+        samples = self._map()[entry["offset"]:entry["offset"] + size]
+        return SampleBuffer(samples.reshape(entry["frames"], entry["channels"]), entry["sample_rate"])
+
+    def archive(self, archive_dir: Path, names: Optional[list[str]]=None) -> list[Path]:
+        """Write lossless FLAC copies of the stored clauses, about half the size of the WAVs."""
+        # Imported here since only archiving needs an encoder
+        from pedalboard.io import AudioFile # type: ignore
+
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        with profiler.stage("archive"):
+            for name in names if names is not None else list(self.index):
+                buffer = self.get(name)
+                path = archive_dir / f"{name}.flac"
+                with AudioFile(str(path), "w", buffer.sample_rate, buffer.channels, bit_depth=16) as audio_file:
+                    audio_file.write(np.ascontiguousarray(buffer.samples.T))
+                profiler.count("archive", bytes=path.stat().st_size)
+                paths.append(path)
+        return paths
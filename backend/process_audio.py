@@ -1,143 +1,262 @@
-import io
+import functools
 import logging
-import os
-import subprocess
-import tempfile
+from dataclasses import dataclass
+from typing import Optional
 
+import numpy as np
 import pyphen # type: ignore
-import spacy
-from aeneas.executetask import ExecuteTask # type: ignore
-from aeneas.syncmap.fragment import SyncMapFragment # type: ignore
-from aeneas.task import Task # type: ignore
-from pydub import AudioSegment, silence # type: ignore
 
-from backend.schemas import FragmentBase, ProcessedAudio, AudioReport, Clause
-from backend.common import rescaled_noise
+from backend.alignment import AlignedFragment
+from backend.audio_buffer import SampleBuffer
+from backend.schemas import FragmentBase, ProcessedAudio, AudioReport
+from backend.loudness import ClauseLoudness
+from backend.simplex_noise import rescaled_noise_grid
+from backend.time_stretch import TimeStretcher, get_stretcher
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Load the English language model for spaCy
-nlp = spacy.load("en_core_web_sm")
-# Initialize the Pyphen syllable counter with the desired language
-dic = pyphen.Pyphen(lang='en')
 
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """Load a tokenizer-only spaCy pipeline on first use.
 
-def align_clause(audio_filepath: str, clause: Clause):
-    """Align a transcript to an audio file.
-    
-    :param audio_filepath: The path to the audio file.
-    :param transcript: The transcript to align.
-    
-    :return: The alignment.
+    Syllable counting only needs the tokens, and a blank English pipeline splits text
+    exactly like `en_core_web_sm` without loading its tagger, parser and NER.  spaCy
+    itself is imported here since the import alone takes noticeable time.
     """
-    with tempfile.NamedTemporaryFile(mode="w") as transcript_file:
-        transcript_file.write(clause.text)
-        transcript_file.flush()
-        # create Task object
-        config_string = u"task_language=eng|is_text_type=plain|os_task_file_format=json"
-        task = Task(config_string=config_string)
-        task.audio_file_path_absolute = os.path.abspath(audio_filepath)
-        task.text_file_path_absolute = os.path.abspath(transcript_file.name)
-        ExecuteTask(task).execute()
-
-        return task.sync_map_leaves()
+    import spacy
+    return spacy.blank("en")
 
-def process_fragments(
-    input: AudioSegment, 
-    alignment: list[SyncMapFragment], 
-    extend_silence_ms: int=500, 
+@functools.lru_cache(maxsize=None)
+def get_syllable_dictionary() -> pyphen.Pyphen:
+    return pyphen.Pyphen(lang='en')
+
+@functools.lru_cache(maxsize=16384)
+def count_word_syllables(word: str) -> int:
+    # Scripts repeat the same words heavily, so hyphenation results are memoized
+    return len(get_syllable_dictionary().positions(word)) + 1
+
+def count_syllables(text: str) -> int:
+    return sum(count_word_syllables(token.text) for token in get_tokenizer()(text))
+
+
+@dataclass
+class TrimmedFragment:
+    """A fragment cut out of its clause with surrounding silence removed and its gain normalized."""
+    idx: int
+    text: str
+    raw: SampleBuffer
+    nonsilent: SampleBuffer
+
+@dataclass
+class RetimedFragment:
+    """The nonsilent audio of a fragment retimed towards the target speech rate."""
+    processed: SampleBuffer
+    speech_rate: float
+    retime_pct: int
+
+@dataclass
+class PaddedFragment:
+    """The silence added after a fragment."""
+    noise_factor: float
+    random_silence_duration: float
+
+
+def trim_fragments(
+    input: SampleBuffer, 
+    alignment: list[AlignedFragment], 
     min_silence_ms: int=250, 
-    noise_scale: float=0.1, 
-    target_speech_rate: float=3.0, 
     shift_fragment_windows: int=-50,
     target_dbfs: int=-20,
-) -> list[FragmentBase]:
-    """Pad sections of silence in an audio file to be a certain length with additional
-    length +/- the length as determined by the noise function.
-    
-    :param input: The input audio.
-    :param alignment: Determines what rate to slow each segment (helps keep even speaking pace).
-    :param extend_silence_ms: The desired silence extension length in milliseconds.
+) -> list[TrimmedFragment]:
+    """Cut each aligned fragment out of the clause, trim its silence and normalize its gain.
+
+    :param input: The clause audio.
+    :param alignment: The span of each fragment within the clause.
     :param min_silence_len: The threshold for detected silence length in milliseconds.
-    :param noise_scale: The noise scale that determines the range of silence extension.
-    :param target_speech_rate: The target speech rate in syllables per second.
     :param shift_fragment_windows: The number of milliseconds to shift the fragment window to avoid
         the ends being cutoff by inaccuracies in the forced alignmend algorithm.
     :param target_dbfs: The target decibels we want the average volume to be.
-
-    :return: The output audio.
     """
-    fragments = []
-    for idx, fragment in enumerate(alignment):
-        if fragment.is_head_or_tail:
+    # The alignment timestamps tend to be a little off, so we shift the fragment
+    #   window to avoid clicks at the end of each segment or cutting off the end
+    #   of the segment.  If the previous ending fragment window was shifted, the
+    #   beginning of the current fragment window will need to be shifted as well.
+    spoken = [
+        (fragment.index if fragment.index is not None else idx, fragment)
+        for idx, fragment in enumerate(alignment) if not fragment.is_head_or_tail
+    ]
+    windows = [
+        (
+            max(0, int(fragment.begin * 1000) + shift_fragment_windows),
+            int(fragment.end * 1000) + shift_fragment_windows
+        )
+        for _, fragment in spoken
+    ]
+    # Measure the whole clause once and find the nonsilent part of every fragment from it
+    loudness = ClauseLoudness(input)
+    nonsilent_bounds = loudness.nonsilent_bounds(windows, min_silence_ms, -70)
+
+    trimmed = []
+    for (idx, fragment), (fragment_start, fragment_end), nonsilent in zip(spoken, windows, nonsilent_bounds):
+        if nonsilent is None:
+            logger.warning(f"segment {idx}: no audio above the silence threshold, skipping")
             continue
-        # The alignment timestamps tend to be a little off, so we shift the fragment
-        #   window to avoid clicks at the end of each segment or cutting off the end
-        #   of the segment.  If the previous ending fragment window was shifted, the
-        #   beginning of the current fragment window will need to be shifted as well.
-        fragment_start = max(0, int(fragment.begin * 1000) + shift_fragment_windows)
-        fragment_end = int(fragment.end * 1000) + shift_fragment_windows
         raw_segment = input[fragment_start:fragment_end]
-
-        # Translate the noise value to a range of 0.5 to 1.5 since the noise function
-        #   returns a value between 0 and 1 and we want to scale up or down the
-        #   extend_silence_ms value
-        noise_factor = 1 + (rescaled_noise(idx, 1, noise_scale) - 0.5)
-        nonsilent = silence.detect_nonsilent(raw_segment, min_silence_ms, -70)[0]
         nonsilent_segment = raw_segment[nonsilent[0]:nonsilent[1]]
         # Normalize gain across segments by boosting the difference between 
         #   the segments dBFS (average gain) and the target dBFS
-        nonsilent_segment = nonsilent_segment.apply_gain(target_dbfs - nonsilent_segment.dBFS)
+        nonsilent_start = input.ms_to_samples(fragment_start) + raw_segment.ms_to_samples(nonsilent[0])
+        gain_db = target_dbfs - loudness.dbfs(nonsilent_start, nonsilent_start + nonsilent_segment.frame_count)
+        nonsilent_samples = nonsilent_segment.to_float()
+        nonsilent_samples *= 10 ** (gain_db / 20)
+        trimmed.append(TrimmedFragment(
+            idx=idx,
+            text=fragment.text,
+            raw=raw_segment,
+            nonsilent=SampleBuffer.from_float(nonsilent_samples, input.sample_rate),
+        ))
+    return trimmed
 
-        # Export the 'segment' AudioSegment to a bytes object
-        nonsilent_segment_data = nonsilent_segment.export(format="wav")
-        words = nlp(fragment.text)
-        syllable_count = sum([len(dic.positions(token.text)) + 1 for token in words])
-        speech_rate = syllable_count / (len(nonsilent_segment) / 1000)
+def retime_fragments(
+    trimmed: list[TrimmedFragment],
+    target_speech_rate: float=3.0, 
+    stretcher: Optional[TimeStretcher]=None,
+) -> list[RetimedFragment]:
+    """Speed up or slow down each fragment so it's spoken at about `target_speech_rate`.
+
+    :param trimmed: The fragments to retime.
+    :param target_speech_rate: The target speech rate in syllables per second.
+    :param stretcher: The backend used to retime each fragment, defaults to `get_stretcher()`.
+    """
+    stretcher = stretcher or get_stretcher()
+    retimed = []
+    for fragment in trimmed:
+        syllable_count = count_syllables(fragment.text)
+        speech_rate = syllable_count / (len(fragment.nonsilent) / 1000)
         retime_pct = max(-30, int(((target_speech_rate - speech_rate) / speech_rate) * 100))
         logger.debug(
-            f"segment {idx}: speech rate {speech_rate:.2f} syllables per second,"
+            f"segment {fragment.idx}: speech rate {speech_rate:.2f} syllables per second,"
             f"  retiming by {retime_pct}%"
         )
-        # Run SoundStretch with stdin and stdout
-        soundstretch_process = subprocess.Popen(
-            ["SoundStretch", "stdin", "stdout", f"-tempo={retime_pct}", "-speech"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL
+        sample_rate = fragment.nonsilent.sample_rate
+        processed_segment = SampleBuffer.from_float(
+            stretcher.stretch(fragment.nonsilent.to_float(), sample_rate, retime_pct), sample_rate
         )
-        processed_data, _ = soundstretch_process.communicate(input=nonsilent_segment_data.read())
-        
-        # Convert the processed data back to an AudioSegment
-        processed_segment = AudioSegment.from_file(io.BytesIO(processed_data))
         # Remove the last 25ms of the segment to avoid clicks
         processed_segment = processed_segment[:len(processed_segment) - 25]
+        retimed.append(RetimedFragment(processed_segment, speech_rate, retime_pct))
+    return retimed
+
+def padding_schedule(
+    fragment_count: int,
+    extend_silence_ms: int=500, 
+    noise_scale: float=0.1, 
+    first_fragment: int=0,
+) -> list[PaddedFragment]:
+    """Decide how much silence follows each of `fragment_count` fragments, in one vectorized pass.
+
+    The noise is sampled at each fragment's index in the whole script, so the padding keeps
+    varying from clause to clause instead of every clause repeating the same pattern.
 
-        random_silence_duration = max(0, extend_silence_ms * noise_factor)
+    :param fragment_count: The number of fragments to plan for.
+    :param extend_silence_ms: The desired silence extension length in milliseconds.
+    :param noise_scale: The noise scale that determines the range of silence extension.
+    :param first_fragment: The index in the script of the first fragment.
+    """
+    indices = np.arange(first_fragment, first_fragment + fragment_count, dtype=np.float64)
+    # Translate the noise value to a range of 0.5 to 1.5 since the noise function
+    #   returns a value between 0 and 1 and we want to scale up or down the
+    #   extend_silence_ms value
+    noise_factors = 1 + (rescaled_noise_grid(indices, 1, noise_scale) - 0.5)
+    silence_durations = np.maximum(0, extend_silence_ms * noise_factors)
+    return [
+        PaddedFragment(float(noise_factor), float(silence_duration))
+        for noise_factor, silence_duration in zip(noise_factors, silence_durations)
+    ]
+
+def pad_fragments(trimmed: list[TrimmedFragment], schedule: list[PaddedFragment]) -> list[PaddedFragment]:
+    """Look up the silence following each fragment in its clause's share of the padding schedule.
+
+    :param trimmed: The fragments to pad.
+    :param schedule: The padding of every fragment of the clause, including those trimmed away.
+    """
+    padded = []
+    for fragment in trimmed:
+        pad = schedule[fragment.idx]
         logger.debug(
-            f"segment {idx}: using noise value of {noise_factor:.4f}"
-            f" to add {random_silence_duration}ms of silence"
+            f"segment {fragment.idx}: using noise value of {pad.noise_factor:.4f}"
+            f" to add {pad.random_silence_duration}ms of silence"
         )
-        extended_segment = processed_segment + AudioSegment.silent(duration=random_silence_duration)
+        padded.append(pad)
+    return padded
 
+def assemble_fragments(
+    trimmed: list[TrimmedFragment],
+    retimed: list[RetimedFragment],
+    padded: list[PaddedFragment],
+) -> list[FragmentBase]:
+    """Combine the output of each stage into the rendered fragments and their reports."""
+    fragments = []
+    for trim, retime, pad in zip(trimmed, retimed, padded):
+        # The silence is recorded as padding rather than stored, the final mix is zero filled
+        extended_segment = retime.processed.padded(pad.random_silence_duration)
         fragments.append(FragmentBase(
             processed_audio=ProcessedAudio(
-                raw=raw_segment,
-                nonsilent=nonsilent_segment,
-                processed=processed_segment,
+                raw=trim.raw,
+                nonsilent=trim.nonsilent,
+                processed=retime.processed,
                 extended=extended_segment
             ),
             report=AudioReport(
-                speech_rate=speech_rate,
-                retime_pct=retime_pct,
-                noise_factor=noise_factor,
-                raw_length=len(raw_segment),
-                nonsilent_length=len(nonsilent_segment),
-                silent_length=len(raw_segment) - len(nonsilent_segment),
+                speech_rate=retime.speech_rate,
+                retime_pct=retime.retime_pct,
+                noise_factor=pad.noise_factor,
+                raw_length=len(trim.raw),
+                nonsilent_length=len(trim.nonsilent),
+                silent_length=len(trim.raw) - len(trim.nonsilent),
                 extended_length=len(extended_segment),
-                random_silence_duration=random_silence_duration
+                random_silence_duration=pad.random_silence_duration
             ),
-            text=fragment.text,
+            text=trim.text,
         ))
     return fragments
+
+def process_fragments(
+    input: SampleBuffer, 
+    alignment: list[AlignedFragment], 
+    extend_silence_ms: int=500, 
+    min_silence_ms: int=250, 
+    noise_scale: float=0.1, 
+    target_speech_rate: float=3.0, 
+    shift_fragment_windows: int=-50,
+    target_dbfs: int=-20,
+    stretcher: Optional[TimeStretcher]=None,
+    first_fragment: int=0,
+) -> list[FragmentBase]:
+    """Pad sections of silence in an audio file to be a certain length with additional
+    length +/- the length as determined by the noise function.
+    
+    Runs the trim, retime and pad stages back to back, see `backend.render_graph` for
+    running them incrementally.
+
+    :param input: The input audio.
+    :param alignment: Determines what rate to slow each segment (helps keep even speaking pace).
+    :param extend_silence_ms: The desired silence extension length in milliseconds.
+    :param min_silence_len: The threshold for detected silence length in milliseconds.
+    :param noise_scale: The noise scale that determines the range of silence extension.
+    :param target_speech_rate: The target speech rate in syllables per second.
+    :param shift_fragment_windows: The number of milliseconds to shift the fragment window to avoid
+        the ends being cutoff by inaccuracies in the forced alignmend algorithm.
+    :param target_dbfs: The target decibels we want the average volume to be.
+    :param stretcher: The backend used to retime each fragment, defaults to `get_stretcher()`.
+    :param first_fragment: The index of the clause's first fragment in the script, which seeds its padding.
+
+    :return: The output audio, with every fragment's audio held as views into `input` where possible.
+    """
+    trimmed = trim_fragments(input, alignment, min_silence_ms, shift_fragment_windows, target_dbfs)
+    return assemble_fragments(
+        trimmed,
+        retime_fragments(trimmed, target_speech_rate, stretcher),
+        pad_fragments(trimmed, padding_schedule(len(alignment), extend_silence_ms, noise_scale, first_fragment)),
+    )
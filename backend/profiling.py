@@ -0,0 +1,137 @@
+import csv
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Iterator
+
+
+@dataclass
+class StageStats:
+    """Totals for every run of a pipeline stage."""
+    calls: int = 0
+    wall_s: float = 0.0
+    bytes: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+@dataclass
+class TraceEvent:
+    """A single timed run of a stage, as a Chrome trace "complete" event."""
+    name: str
+    start_us: float
+    duration_us: float
+    pid: int
+    tid: int
+    args: dict[str, Any]
+
+ProfileData = tuple[dict[str, StageStats], list[TraceEvent]]
+
+
+class Profiler:
+    """Per-stage timers and counters for the render pipeline.
+
+    Stages are timed with `stage` and add to their counters with `count`, from any thread.
+    Worker processes each have their own profiler, whose measurements are sent back with
+    their results by `drain` and added to the main process's with `merge`.  Timestamps
+    come from the monotonic clock, which processes on the same machine share, so traces
+    from the workers line up with the main process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stats: defaultdict[str, StageStats] = defaultdict(StageStats)
+            self.events: list[TraceEvent] = []
+
+    @contextmanager
+    def stage(self, name: str, **args: Any) -> Iterator[None]:
+        """Time the body as a run of the stage `name`, `args` are shown on the trace event."""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            event = TraceEvent(name, start / 1000, duration / 1000, os.getpid(), threading.get_ident(), args)
+            with self._lock:
+                stats = self.stats[name]
+                stats.calls += 1
+                stats.wall_s += duration / 1e9
+                self.events.append(event)
+
+    def count(self, name: str, bytes: int=0, cache_hits: int=0, cache_misses: int=0):
+        with self._lock:
+            stats = self.stats[name]
+            stats.bytes += bytes
+            stats.cache_hits += cache_hits
+            stats.cache_misses += cache_misses
+
+    def drain(self) -> ProfileData:
+        """Take the measurements made so far, leaving this profiler empty."""
+        with self._lock:
+            data = (dict(self.stats), self.events)
+            self.stats = defaultdict(StageStats)
+            self.events = []
+        return data
+
+    def merge(self, data: ProfileData):
+        stats, events = data
+        with self._lock:
+            for name, stage_stats in stats.items():
+                totals = self.stats[name]
+                totals.calls += stage_stats.calls
+                totals.wall_s += stage_stats.wall_s
+                totals.bytes += stage_stats.bytes
+                totals.cache_hits += stage_stats.cache_hits
+                totals.cache_misses += stage_stats.cache_misses
+            self.events.extend(events)
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {name: asdict(stats) for name, stats in self.stats.items()}
+
+    def write_summary(self, path: Path):
+        """Write the totals of every stage as JSON, or as CSV when `path` ends in .csv."""
+        summary = self.summary()
+        with open(path, "w", newline="") as summary_file:
+            if Path(path).suffix == ".csv":
+                writer = csv.DictWriter(summary_file, fieldnames=["stage", *StageStats.__dataclass_fields__])
+                writer.writeheader()
+                for name, stats in summary.items():
+                    writer.writerow({"stage": name, **stats})
+            else:
+                json.dump(summary, summary_file, indent=2)
+
+    def write_trace(self, path: Path):
+        """Write every timed run as a Chrome trace, viewable in chrome://tracing or Perfetto."""
+        with self._lock:
+            trace_events = [
+                {
+                    "name": event.name,
+                    "ph": "X",
+                    "ts": event.start_us,
+                    "dur": event.duration_us,
+                    "pid": event.pid,
+                    "tid": event.tid,
+                    "args": event.args,
+                }
+                for event in self.events
+            ]
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": trace_events}, trace_file)
+
+    def format_summary(self) -> list[str]:
+        return [
+            f"{name:>12}: {stats['calls']:5d} runs  {stats['wall_s']:8.2f}s  {stats['bytes'] / 1e6:9.1f}MB"
+            f"  {stats['cache_hits']} cache hits, {stats['cache_misses']} misses"
+            for name, stats in self.summary().items()
+        ]
+
+# The profiler of this process, see `Profiler` for combining it with worker processes'
+profiler = Profiler()
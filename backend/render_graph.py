@@ -0,0 +1,264 @@
+import hashlib
+import json
+import pickle
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from backend.alignment import AlignedFragment
+from backend.audio_buffer import SampleBuffer
+from backend.common import CACHE_DIR, atomic_write
+from backend.process_audio import (
+    PaddedFragment, assemble_fragments, pad_fragments, padding_schedule, retime_fragments, trim_fragments
+)
+from backend.profiling import profiler
+from backend.schemas import Clause, FragmentBase, Script
+from backend.time_stretch import TimeStretcher
+from backend.timing import SessionSchedule
+
+ARTIFACTS_DIR = CACHE_DIR / "artifacts"
+# The render parameters each clause stage depends on
+STAGE_PARAMS = {
+    "trim": ("min_silence_ms", "shift_fragment_windows", "target_dbfs"),
+    "retime": ("target_speech_rate", "stretcher"),
+    "pad": ("extend_silence_ms", "noise_scale"),
+    "schedule": ("extend_silence_ms", "noise_scale"),
+}
+
+
+@dataclass
+class StageNode:
+    """One stage of the render for one clause (or the whole script), keyed on everything it depends on.
+
+    The key hashes the stage's own parameters together with the keys of its upstream
+    nodes, so any change upstream also changes the key of every node downstream of it.
+    """
+    node_id: str
+    stage: str
+    params: dict[str, Any]
+    upstream: list["StageNode"] = field(default_factory=list)
+    key: str = field(init=False)
+
+    def __post_init__(self):
+        payload = json.dumps(
+            {"stage": self.stage, "params": self.params, "upstream": [node.key for node in self.upstream]},
+            sort_keys=True, default=str
+        )
+        self.key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ClausePlan:
+    name: str
+    audio_path: Path
+    clause: Clause
+    nodes: dict[str, StageNode]
+    # The index of the clause's first fragment in the script, which seeds its padding
+    first_fragment: int = 0
+
+
+class ArtifactStore:
+    """Pickled stage outputs on disk, stored by stage and node key.
+
+    :param root: The directory holding a subdirectory of artifacts per stage.
+    """
+    def __init__(self, root: Path=ARTIFACTS_DIR):
+        self.root = Path(root)
+
+    def path(self, node: StageNode) -> Path:
+        return self.root / node.stage / f"{node.key}.pickle"
+
+    def has(self, node: StageNode) -> bool:
+        return self.path(node).exists()
+
+    def load(self, node: StageNode) -> Any:
+        with open(self.path(node), "rb") as artifact_file:
+            return pickle.load(artifact_file)
+
+    def save(self, node: StageNode, value: Any):
+        path = self.path(node)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def load_or_compute(self, node: StageNode, compute: Callable[[], Any]) -> Any:
+        with profiler.stage(node.stage, node=node.node_id):
+            if self.has(node):
+                value = self.load(node)
+                profiler.count(node.stage, bytes=self.path(node).stat().st_size, cache_hits=1)
+                return value
+            value = compute()
+            self.save(node, value)
+            profiler.count(node.stage, bytes=self.path(node).stat().st_size, cache_misses=1)
+            return value
+
+
+class RenderPlan:
+    """The stages needed to render a script and which of them are already up to date.
+
+    The pipeline is fetch -> align -> trim -> retime -> pad per clause, followed by
+    concatenate and report for the whole script.  The padding of every fragment is
+    planned for the whole script up front by the schedule stage.  Clause stages are
+    fresh when an artifact exists for their key, the file producing stages (fetch,
+    concatenate and report) when their file exists and the manifest from the last run
+    recorded the same key.
+
+    :param script: The script to render.
+    :param audio_dir: Where the script's clause audio, output and report are written.
+    :param voice_name: The TTS voice reading the script.
+    :param params: The render parameters, as passed to `process_fragments`.
+    :param stretcher: The name of the time stretch backend.
+    :param store: Where the clause stage outputs are kept.
+    """
+    manifest_name = "render_manifest.json"
+
+    def __init__(
+        self, 
+        script: Script, 
+        audio_dir: Path, 
+        voice_name: str, 
+        params: dict[str, Any], 
+        stretcher: str, 
+        store: Optional[ArtifactStore]=None,
+    ):
+        self.audio_dir = audio_dir
+        self.raw_dir = audio_dir / "raw"
+        self.store = store or ArtifactStore()
+        params = dict(params, stretcher=stretcher)
+
+        manifest_path = audio_dir / self.manifest_name
+        self.manifest: dict[str, dict[str, Any]] = {}
+        if manifest_path.exists():
+            with open(manifest_path, "r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+        self.params = params
+        self.sections: list[list[ClausePlan]] = []
+        first_fragment = 0
+        for section_ix, section in enumerate(script.sections):
+            clause_plans = []
+            for clause_ix, clause in enumerate(section.clauses):
+                name = f"{section_ix}_{section.name}_{clause_ix}"
+                fetch = StageNode(f"{name}/fetch", "fetch", {"voice_name": voice_name, "text": clause.text})
+                align = StageNode(f"{name}/align", "align", {"transcript": clause.text}, [fetch])
+                trim = StageNode(f"{name}/trim", "trim", self._params("trim", params), [align])
+                retime = StageNode(f"{name}/retime", "retime", self._params("retime", params), [trim])
+                pad = StageNode(f"{name}/pad", "pad", dict(self._params("pad", params), first_fragment=first_fragment), [trim])
+                clause_plans.append(ClausePlan(
+                    name, 
+                    self.raw_dir / f"{name}.wav", 
+                    clause,
+                    {node.stage: node for node in (fetch, align, trim, retime, pad)},
+                    first_fragment,
+                ))
+                first_fragment += len(clause.fragments)
+            self.sections.append(clause_plans)
+
+        fragment_counts = [len(plan.clause.fragments) for plan in self.clauses]
+        self.schedule = StageNode("output/schedule", "schedule", dict(self._params("schedule", params), fragment_counts=fragment_counts))
+
+        clause_outputs = [node for plan in self.clauses for node in (plan.nodes["retime"], plan.nodes["pad"])]
+        self.concatenate = StageNode("output/concatenate", "concatenate", {}, clause_outputs)
+        self.report = StageNode("output/report", "report", {}, [self.concatenate])
+
+    @staticmethod
+    def _params(stage: str, params: dict[str, Any]) -> dict[str, Any]:
+        return {name: params[name] for name in STAGE_PARAMS[stage] if name in params}
+
+    @property
+    def clauses(self) -> list[ClausePlan]:
+        return [plan for section in self.sections for plan in section]
+
+    @property
+    def nodes(self) -> list[StageNode]:
+        return [self.schedule] + [node for plan in self.clauses for node in plan.nodes.values()] + [self.concatenate, self.report]
+
+    def output_path(self, node: StageNode) -> Optional[Path]:
+        if node.stage == "fetch":
+            return self.raw_dir / f"{node.node_id.split('/')[0]}.wav"
+        if node.stage == "concatenate":
+            return self.audio_dir / "output.wav"
+        if node.stage == "report":
+            return self.audio_dir / "report.html"
+        return None
+
+    def is_fresh(self, node: StageNode) -> bool:
+        output_path = self.output_path(node)
+        if output_path is None:
+            return self.store.has(node)
+        recorded = self.manifest.get(node.node_id)
+        return output_path.exists() and recorded is not None and recorded["key"] == node.key
+
+    def reason(self, node: StageNode) -> str:
+        """Explain why `node` would be recomputed."""
+        recorded = self.manifest.get(node.node_id)
+        if recorded is None:
+            return "not rendered before"
+        if recorded["key"] == node.key:
+            return "output is missing"
+        changed = [
+            f"{name} changed from {recorded['params'].get(name)!r} to {value!r}"
+            for name, value in node.params.items()
+            if recorded["params"].get(name) != value
+        ]
+        if changed:
+            return ", ".join(changed)
+        stale_upstream = sorted({upstream.stage for upstream in node.upstream if not self.is_fresh(upstream)})
+        if stale_upstream:
+            return f"upstream {', '.join(stale_upstream)} changed"
+        return "inputs changed"
+
+    def explain(self) -> list[str]:
+        lines = []
+        for node in self.nodes:
+            if self.is_fresh(node):
+                lines.append(f"{node.node_id}: up to date")
+            else:
+                lines.append(f"{node.node_id}: recompute, {self.reason(node)}")
+        return lines
+
+    def load_schedule(self) -> SessionSchedule:
+        """The padding of every fragment in the script, planned once and stored like the clause stages."""
+        return self.store.load_or_compute(self.schedule, lambda: SessionSchedule.plan(
+            self.schedule.params["fragment_counts"], self.params["extend_silence_ms"], self.params["noise_scale"]
+        ))
+
+    def save_manifest(self):
+        manifest = {node.node_id: {"key": node.key, "params": node.params} for node in self.nodes}
+        atomic_write(
+            self.audio_dir / self.manifest_name, 
+            json.dumps(manifest, indent=2, default=str).encode("utf-8")
+        )
+
+
+def render_clause_stages(
+    plan: ClausePlan,
+    store: ArtifactStore,
+    params: dict[str, Any],
+    audio: Optional[SampleBuffer],
+    alignment: Optional[list[AlignedFragment]],
+    stretcher: Optional[TimeStretcher]=None,
+    padding: Optional[list[PaddedFragment]]=None,
+) -> list[tuple[int, FragmentBase]]:
+    """Run the trim, retime and pad stages of a clause, loading any that are already stored.
+
+    `audio` and `alignment` are only needed when the trim stage has to be recomputed, and
+    `padding`, the clause's share of the `SessionSchedule`, is planned here when not given.
+    Every rendered fragment is returned with its index in the clause, since fragments the
+    trim stage drops leave gaps.
+    """
+    nodes = plan.nodes
+    trimmed = store.load_or_compute(nodes["trim"], lambda: trim_fragments(
+        audio if audio is not None else SampleBuffer.from_file(plan.audio_path),
+        alignment if alignment is not None else store.load(nodes["align"]),
+        **{name: params[name] for name in STAGE_PARAMS["trim"] if name in params}
+    ))
+    retimed = store.load_or_compute(nodes["retime"], lambda: retime_fragments(
+        trimmed, params["target_speech_rate"], stretcher
+    ))
+    padded = store.load_or_compute(nodes["pad"], lambda: pad_fragments(
+        trimmed, 
+        padding if padding is not None else padding_schedule(
+            len(plan.clause.fragments), params["extend_silence_ms"], params["noise_scale"], plan.first_fragment
+        )
+    ))
+    return list(zip([trim.idx for trim in trimmed], assemble_fragments(trimmed, retimed, padded)))
@@ -0,0 +1,258 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from itertools import groupby
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, Sequence
+from uuid import UUID
+
+from backend.profiling import profiler
+from backend.schemas import Clause, Fragment, ProcessedAudio, Script, Section
+
+# Rows per multi-row statement, keeping SQLite under its limit of bound parameters
+BATCH_ROWS = 500
+
+# The tables of `schemas.sql` in SQLite, for running the repository locally and in tests
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scripts (
+    id TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP,
+    name VARCHAR(255) NOT NULL,
+    summary TEXT NOT NULL,
+    audio_url TEXT
+);
+CREATE TABLE IF NOT EXISTS sections (
+    id TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP,
+    sort_order INT NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    summary TEXT NOT NULL,
+    audio_url TEXT,
+    script_id TEXT NOT NULL REFERENCES scripts(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS clauses (
+    id TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP,
+    sort_order INT NOT NULL,
+    audio_url TEXT,
+    section_id TEXT NOT NULL REFERENCES sections(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS fragments (
+    id TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP,
+    sort_order INT NOT NULL,
+    content TEXT NOT NULL,
+    audio_url TEXT,
+    section_id TEXT NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
+    clause_id TEXT NOT NULL REFERENCES clauses(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS sections_script_id_sort_order ON sections (script_id, sort_order);
+CREATE INDEX IF NOT EXISTS clauses_section_id_sort_order ON clauses (section_id, sort_order);
+CREATE INDEX IF NOT EXISTS fragments_section_id_sort_order ON fragments (section_id, sort_order);
+CREATE INDEX IF NOT EXISTS fragments_clause_id ON fragments (clause_id);
+"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of DB-API connections, opened with `connect` as they're first needed.
+
+    :param connect: Opens a new connection.
+    :param max_size: Most connections open at once, `connection` blocks while all are in use.
+    """
+    def __init__(self, connect: Callable[[], Any], max_size: int=4):
+        self._connect = connect
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except BaseException:
+                # A connection that failed mid-use may be unusable, don't hand it out again
+                conn.close()
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+def sqlite_pool(path: Path, max_size: int=4) -> ConnectionPool:
+    """A pool of connections to the SQLite database at `path`, created with `SQLITE_SCHEMA` if needed."""
+    def connect() -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.executescript(SQLITE_SCHEMA)
+        return conn
+    return ConnectionPool(connect, max_size)
+
+def postgres_pool(dsn: str, max_size: int=4) -> ConnectionPool:
+    """A pool of connections to the Postgres database at `dsn`, with the tables of `schemas.sql`."""
+    # Imported here so the SQLite pool works without a Postgres driver installed
+    import psycopg2 # type: ignore
+    return ConnectionPool(lambda: psycopg2.connect(dsn), max_size)
+
+
+def chunked(rows: Sequence[tuple], size: int=BATCH_ROWS) -> Iterator[Sequence[tuple]]:
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def fragment_audio_url(fragment: Fragment) -> Optional[str]:
+    """The fragment's exported audio, once `main.export_clause_audio` has replaced its buffers with URLs."""
+    audio = fragment.processed_audio
+    if audio and isinstance(audio.extended, str):
+        return audio.extended
+    return None
+
+
+class ScriptRepository:
+    """Saves and loads whole script trees in a few set-based statements per table.
+
+    `save` upserts every row of a level with multi-row `INSERT ... ON CONFLICT` statements
+    and deletes the rows the script no longer has, all in one transaction, so a script
+    costs a handful of round trips however many fragments it has.  `load` reads each
+    level with one query in `sort_order`, served by the `(parent, sort_order)` indexes.
+
+    :param pool: Where connections come from, see `sqlite_pool` and `postgres_pool`.
+    :param placeholder: The driver's parameter marker, "?" for sqlite3 and "%s" for psycopg2.
+    """
+    def __init__(self, pool: ConnectionPool, placeholder: str="?"):
+        self.pool = pool
+        self.placeholder = placeholder
+
+    def _upsert(self, cursor, table: str, columns: Sequence[str], rows: Sequence[tuple], keep: Sequence[str]=()):
+        """Insert `rows`, updating the existing rows with the same id except for the `keep` columns."""
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id" and column not in keep)
+        row_marks = "(" + ", ".join([self.placeholder] * len(columns)) + ")"
+        for batch in chunked(rows):
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_marks] * len(batch))}"
+                f" ON CONFLICT (id) DO UPDATE SET {updates}",
+                [value for row in batch for value in row]
+            )
+
+    def _delete_missing(self, cursor, table: str, parent_column: str, parent_ids: Sequence[str], ids: Sequence[str]):
+        """Delete the rows under `parent_ids` whose ids aren't in `ids`."""
+        if not parent_ids:
+            return
+        parent_marks = ", ".join([self.placeholder] * len(parent_ids))
+        cursor.execute(f"SELECT id FROM {table} WHERE {parent_column} IN ({parent_marks})", list(parent_ids))
+        kept = set(ids)
+        stale = [(row_id,) for row_id, in cursor.fetchall() if str(row_id) not in kept]
+        for batch in chunked(stale):
+            marks = ", ".join([self.placeholder] * len(batch))
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({marks})", [row_id for row_id, in batch])
+
+    def save(self, script: Script):
+        """Create or replace `script` and everything in it."""
+        script_id = str(script.id)
+        section_rows = []
+        clause_rows = []
+        fragment_rows = []
+        for section_order, section in enumerate(script.sections):
+            fragment_order = 0
+            for clause_order, clause in enumerate(section.clauses):
+                clause_rows.append((str(clause.id), clause_order, clause.audio, str(section.id)))
+                for fragment in clause.fragments:
+                    fragment_rows.append((
+                        str(fragment.id), fragment_order, fragment.text, fragment_audio_url(fragment),
+                        str(section.id), str(clause.id)
+                    ))
+                    fragment_order += 1
+            section_rows.append((str(section.id), section_order, section.name, "", section.audio, script_id))
+
+        with profiler.stage("save_script"), self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                # The summaries aren't part of the models, so existing ones are kept
+                self._upsert(cursor, "scripts", ("id", "name", "summary"), [(script_id, script.name, "")], keep=("summary",))
+                self._upsert(cursor, "sections", ("id", "sort_order", "name", "summary", "audio_url", "script_id"), section_rows, keep=("summary",))
+                self._delete_missing(cursor, "sections", "script_id", [script_id], [row[0] for row in section_rows])
+                section_ids = [row[0] for row in section_rows]
+                self._upsert(cursor, "clauses", ("id", "sort_order", "audio_url", "section_id"), clause_rows)
+                self._delete_missing(cursor, "clauses", "section_id", section_ids, [row[0] for row in clause_rows])
+                self._upsert(cursor, "fragments", ("id", "sort_order", "content", "audio_url", "section_id", "clause_id"), fragment_rows)
+                self._delete_missing(cursor, "fragments", "section_id", section_ids, [row[0] for row in fragment_rows])
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+            profiler.count("save_script", bytes=sum(len(row[2]) for row in fragment_rows))
+
+    def load(self, script_id: UUID) -> Script:
+        """Read the script with `script_id` and everything in it, in order."""
+        mark = self.placeholder
+        with profiler.stage("load_script"), self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT id, name FROM scripts WHERE id = {mark}", [str(script_id)])
+                script_row = cursor.fetchone()
+                if not script_row:
+                    raise Exception(f"Script not found: {script_id}")
+                cursor.execute(
+                    f"SELECT id, name, audio_url FROM sections WHERE script_id = {mark} ORDER BY sort_order",
+                    [str(script_id)]
+                )
+                section_rows = cursor.fetchall()
+                cursor.execute(
+                    "SELECT c.section_id, c.id, c.audio_url FROM clauses c JOIN sections s ON s.id = c.section_id"
+                    f" WHERE s.script_id = {mark} ORDER BY s.sort_order, c.sort_order",
+                    [str(script_id)]
+                )
+                clause_rows = cursor.fetchall()
+                cursor.execute(
+                    "SELECT f.clause_id, f.id, f.content, f.audio_url FROM fragments f JOIN sections s ON s.id = f.section_id"
+                    f" WHERE s.script_id = {mark} ORDER BY s.sort_order, f.sort_order",
+                    [str(script_id)]
+                )
+                fragment_rows = cursor.fetchall()
+                conn.commit()
+            finally:
+                cursor.close()
+
+        fragments_by_clause = {
+            str(clause_id): [
+                Fragment(
+                    id=fragment_id,
+                    text=content,
+                    processed_audio=ProcessedAudio(raw=None, nonsilent=None, processed=None, extended=audio_url) if audio_url else None,
+                    report=None,
+                )
+                for _, fragment_id, content, audio_url in rows
+            ]
+            for clause_id, rows in groupby(fragment_rows, key=lambda row: row[0])
+        }
+        clauses_by_section = {
+            str(section_id): [
+                Clause(id=clause_id, audio=audio_url, fragments=fragments_by_clause.get(str(clause_id), []))
+                for _, clause_id, audio_url in rows
+            ]
+            for section_id, rows in groupby(clause_rows, key=lambda row: row[0])
+        }
+        return Script(
+            id=script_row[0],
+            name=script_row[1],
+            sections=[
+                Section(id=section_id, name=name, audio=audio_url, clauses=clauses_by_section.get(str(section_id), []))
+                for section_id, name, audio_url in section_rows
+            ],
+        )
@@ -1,13 +1,14 @@
-from typing import Optional
+from typing import Any, Optional
 from uuid import UUID
 
 from pydantic import BaseModel
 
 class ProcessedAudio(BaseModel):
-    raw: str
-    nonsilent: str
-    processed: str
-    extended: str
+    # Rendered audio buffers (`backend.audio_buffer.SampleBuffer`)
+    raw: Any
+    nonsilent: Any
+    processed: Any
+    extended: Any
 
 class AudioReport(BaseModel):
     speech_rate: float
@@ -47,6 +47,25 @@ BEFORE UPDATE ON sections
 FOR EACH ROW
 EXECUTE FUNCTION update_updated_at_column();
 
+CREATE TABLE clauses (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP,
+    sort_order INT NOT NULL,
+
+    audio_url TEXT,
+
+    section_id UUID NOT NULL
+        REFERENCES sections(id) 
+        ON DELETE CASCADE
+);
+
+CREATE OR REPLACE TRIGGER update_scripts_updated_at
+BEFORE UPDATE ON clauses
+FOR EACH ROW
+EXECUTE FUNCTION update_updated_at_column();
+
+-- `sort_order` is the fragment's position in its section, across clauses
 CREATE TABLE fragments (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     created_at TIMESTAMP NOT NULL DEFAULT NOW(),
@@ -54,14 +73,23 @@ CREATE TABLE fragments (
     sort_order INT NOT NULL,
 
     content TEXT NOT NULL,
-    audio_url TEXT NOT NULL,
+    audio_url TEXT,
 
     section_id UUID NOT NULL
         REFERENCES sections(id) 
+        ON DELETE CASCADE,
+    clause_id UUID NOT NULL
+        REFERENCES clauses(id) 
         ON DELETE CASCADE
 );
 
 CREATE OR REPLACE TRIGGER update_scripts_updated_at
 BEFORE UPDATE ON fragments
 FOR EACH ROW
-EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file
+EXECUTE FUNCTION update_updated_at_column();
+
+-- Children are always read in order of their parent
+CREATE INDEX sections_script_id_sort_order ON sections (script_id, sort_order);
+CREATE INDEX clauses_section_id_sort_order ON clauses (section_id, sort_order);
+CREATE INDEX fragments_section_id_sort_order ON fragments (section_id, sort_order);
+CREATE INDEX fragments_clause_id ON fragments (clause_id);
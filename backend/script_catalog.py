@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+from uuid import NAMESPACE_URL, uuid5
+
+import orjson
+from pydantic import ValidationError
+
+from backend.common import CACHE_DIR, atomic_write, bounded_map
+from backend.profiling import profiler
+from backend.schemas import Script
+
+# Bumped when the manifest's format or how scripts are validated changes, see `manifest_stamp`
+MANIFEST_VERSION = 2
+
+
+@dataclass
+class CatalogEntry:
+    """What the catalog knows about one script file, persisted in its manifest."""
+    path: Path
+    mtime_ns: int
+    size: int
+    sha256: str = ""
+    errors: list[str] = field(default_factory=list)
+    # The render key the script was last rendered with, see `ScriptCatalog.pending`
+    rendered: Optional[str] = None
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+
+def with_ids(data: dict[str, Any]) -> dict[str, Any]:
+    """Expand a script as authored, with clauses as lists of fragment texts, into the `Script` fields.
+
+    Ids the file doesn't have are derived from the script name and the position of the
+    section, clause or fragment, so they're the same on every run.
+    """
+    name = data.get("name")
+    def stable_id(*position: int) -> str:
+        return str(uuid5(NAMESPACE_URL, "/".join([f"script:{name}", *map(str, position)])))
+
+    sections = []
+    for section_ix, section in enumerate(data.get("sections") or []):
+        if not isinstance(section, dict):
+            sections.append(section)
+            continue
+        clauses = []
+        for clause_ix, clause in enumerate(section.get("clauses") or []):
+            if isinstance(clause, list):
+                clause = {"fragments": [
+                    {"text": text} if isinstance(text, str) else text for text in clause
+                ]}
+            if isinstance(clause, dict):
+                fragments = [
+                    {"id": stable_id(section_ix, clause_ix, fragment_ix), **fragment} if isinstance(fragment, dict) else fragment
+                    for fragment_ix, fragment in enumerate(clause.get("fragments") or [])
+                ]
+                clause = {"id": stable_id(section_ix, clause_ix), **clause, "fragments": fragments}
+            clauses.append(clause)
+        sections.append({"id": stable_id(section_ix), **section, "clauses": clauses})
+    return {"id": stable_id(), **data, "sections": sections}
+
+def load_script_file(job: tuple[Path, str]) -> tuple[str, Optional[Script], list[str]]:
+    """Read, hash and validate a script file, returning its hash, the script and every error found.
+
+    Files whose hash matches `known_sha256` aren't parsed again, they're returned without a script.
+    """
+    path, known_sha256 = job
+    data = path.read_bytes()
+    sha256 = hashlib.sha256(data).hexdigest()
+    if sha256 == known_sha256:
+        return sha256, None, []
+    try:
+        parsed = orjson.loads(data)
+    except orjson.JSONDecodeError as e:
+        return sha256, None, [f"{path}: invalid JSON: {e}"]
+    if not isinstance(parsed, dict):
+        return sha256, None, [f"{path}: expected an object, got {type(parsed).__name__}"]
+    try:
+        return sha256, Script.parse_obj(with_ids(parsed)), []
+    except ValidationError as e:
+        return sha256, None, [
+            f"{path}: {'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()
+        ]
+
+def manifest_stamp() -> str:
+    """Identifies the manifest format and the `Script` schema its validation results depend on."""
+    schema_hash = hashlib.sha256(Script.schema_json().encode("utf-8")).hexdigest()
+    return f"{MANIFEST_VERSION}:{schema_hash}"
+
+
+class ScriptCatalog:
+    """The scripts under a directory, re-reading only the files that changed since the last scan.
+
+    A manifest keeps the mtime, size and content hash of every file with its validation
+    errors.  Files with the same mtime and size aren't opened, files that were touched but
+    hash the same aren't parsed, and the rest are parsed and validated in parallel with
+    every error collected.  `pending` lazily yields the valid scripts that changed since
+    they were last rendered.  The manifest is stamped with `manifest_stamp` and discarded
+    when the stamp changes, so every file is validated again against a changed schema.
+
+    :param directory: The directory searched for .json scripts, including subdirectories.
+    :param manifest_path: Where the manifest is kept between runs.
+    :param workers: Number of processes validating changed files, defaults to the number of CPUs.
+    """
+    def __init__(self, directory: Path=Path("scripts"), manifest_path: Path=CACHE_DIR / "script_catalog.json", workers: Optional[int]=None):
+        self.directory = Path(directory)
+        self.manifest_path = Path(manifest_path)
+        self.workers = workers or os.cpu_count() or 1
+        self.entries: dict[Path, CatalogEntry] = {}
+        # Scripts parsed by the last scan, so `pending` doesn't parse them again
+        self.parsed: dict[Path, Script] = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "rb") as manifest_file:
+                manifest = orjson.loads(manifest_file.read())
+            if isinstance(manifest, dict) and manifest.get("stamp") == manifest_stamp():
+                for path, entry in manifest["entries"].items():
+                    self.entries[Path(path)] = CatalogEntry(path=Path(path), **entry)
+
+    def _walk(self, directory: Path) -> Iterator[os.DirEntry]:
+        with os.scandir(directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir():
+                    yield from self._walk(Path(dir_entry.path))
+                elif dir_entry.name.endswith(".json"):
+                    yield dir_entry
+
+    def scan(self) -> list[str]:
+        """Bring the catalog up to date with the directory, returning every validation error."""
+        with profiler.stage("scan_scripts"):
+            entries = {}
+            changed = []
+            for dir_entry in self._walk(self.directory):
+                path = Path(dir_entry.path)
+                stat = dir_entry.stat()
+                entry = self.entries.get(path)
+                if entry and (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+                    entries[path] = entry
+                    continue
+                entries[path] = CatalogEntry(
+                    path=path,
+                    mtime_ns=stat.st_mtime_ns,
+                    size=stat.st_size,
+                    sha256=entry.sha256 if entry else "",
+                    errors=entry.errors if entry else [],
+                    rendered=entry.rendered if entry else None,
+                )
+                changed.append(path)
+
+            jobs = [(path, entries[path].sha256) for path in changed]
+            executor = ProcessPoolExecutor(self.workers) if self.workers > 1 and len(jobs) > 1 else None
+            try:
+                for path, (sha256, script, errors) in zip(changed, bounded_map(executor, load_script_file, jobs, self.workers * 2)):
+                    entry = entries[path]
+                    if sha256 == entry.sha256:
+                        profiler.count("scan_scripts", cache_hits=1)
+                        continue
+                    profiler.count("scan_scripts", bytes=entry.size, cache_misses=1)
+                    entry.sha256 = sha256
+                    entry.errors = errors
+                    if script:
+                        self.parsed[path] = script
+            finally:
+                if executor:
+                    executor.shutdown()
+
+            self.entries = entries
+            self.save()
+        return [error for entry in self.entries.values() for error in entry.errors]
+
+    def save(self):
+        entries = {
+            str(path): {
+                "mtime_ns": entry.mtime_ns,
+                "size": entry.size,
+                "sha256": entry.sha256,
+                "errors": entry.errors,
+                "rendered": entry.rendered,
+            }
+            for path, entry in self.entries.items()
+        }
+        manifest = {"stamp": manifest_stamp(), "entries": entries}
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.manifest_path, json.dumps(manifest, indent=2).encode("utf-8"))
+
+    def load(self, path: Path) -> Script:
+        script = self.parsed.pop(path, None)
+        if script:
+            return script
+        _, script, errors = load_script_file((path, ""))
+        if not script:
+            raise Exception("\n".join(errors))
+        return script
+
+    def scripts(self) -> Iterator[tuple[Path, Script]]:
+        """Every valid script, parsed as it's reached."""
+        for path, entry in sorted(self.entries.items()):
+            if entry.valid:
+                yield path, self.load(path)
+
+    def pending(self, render_key: str, is_rendered: Optional[Callable[[Script], bool]]=None) -> Iterator[tuple[Path, Script]]:
+        """The valid scripts not yet rendered with `render_key` since they last changed, parsed as they're reached.
+
+        :param render_key: Identifies everything besides the script that the render depends on.
+        :param is_rendered: Checks that the output of a script recorded as rendered is still
+            there and up to date.  Scripts failing it lose their record and are yielded.
+        """
+        for path, entry in sorted(self.entries.items()):
+            if not entry.valid:
+                continue
+            script = None
+            if entry.rendered == f"{entry.sha256}:{render_key}":
+                if is_rendered is None:
+                    continue
+                script = self.load(path)
+                if is_rendered(script):
+                    continue
+                # The output went missing, so the script's render graph decides what to rebuild
+                entry.rendered = None
+                self.save()
+            yield path, script or self.load(path)
+
+    def mark_rendered(self, path: Path, render_key: str):
+        """Record that the script at `path` was rendered with `render_key`, so `pending` skips it."""
+        entry = self.entries[path]
+        entry.rendered = f"{entry.sha256}:{render_key}"
+        self.save()
@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
+from uuid import uuid4
+
+import aiofiles
+import aiofiles.os
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from backend.main import RENDER_PARAMS, VOICE_NAME, ProgressCallback, render_script
+from backend.schemas import Script
+
+
+logger = logging.getLogger(__name__)
+
+# Read size when streaming audio back to the client
+CHUNK_BYTES = 256 * 1024
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+# Script names become directory names, so they can't hold separators or start with a dot
+SCRIPT_NAME_PATTERN = re.compile(r"\w[\w .-]{0,254}")
+
+
+class JobBackend(ABC):
+    """Runs render jobs somewhere, reporting their progress from any thread."""
+    @abstractmethod
+    def submit(self, key: str, script: Script, progress: ProgressCallback) -> Future:
+        """Start rendering `script`, the future resolves to the directory holding its output."""
+
+    def shutdown(self):
+        pass
+
+
+class LocalJobBackend(JobBackend):
+    """Renders in this process on a bounded pool of threads, each render using `jobs` processes.
+
+    Renders share the module-level profiler and the current directory, so keep `max_workers`
+    at 1 unless that's acceptable.
+    """
+    def __init__(self, audio_root: Path=Path("audio", "renders"), max_workers: int=1, jobs: int=1):
+        self.audio_root = audio_root
+        self.jobs = jobs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+
+    def submit(self, key: str, script: Script, progress: ProgressCallback) -> Future:
+        return self.executor.submit(
+            render_script, script, self.audio_root / key, jobs=self.jobs, progress=progress
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+@dataclass
+class RenderJob:
+    id: str
+    key: str
+    script_name: str
+    status: str = "queued"
+    events: list[dict[str, Any]] = field(default_factory=list)
+    audio_dir: Optional[Path] = None
+    error: Optional[str] = None
+    # Set and replaced every time an event arrives, waking the event streams
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "script": self.script_name,
+            "status": self.status,
+            "progress": self.events[-1] if self.events else None,
+            "error": self.error,
+        }
+
+
+class RenderQueue:
+    """Accepts scripts and tracks their renders, coalescing identical submissions.
+
+    Scripts are keyed by a hash of their content and the render settings, so submitting a
+    script that's queued, rendering or rendered returns the existing job.  Failed jobs are
+    retried by the next submission.  At most `max_pending` jobs can be unfinished at once,
+    and only the last `max_finished` finished jobs are kept, older ones are forgotten and
+    render again if they're submitted again.
+
+    :param backend: Where the renders run.
+    :param max_pending: Number of queued or rendering jobs past which submissions are refused.
+    :param max_finished: Number of done or failed jobs kept, along with their events.
+    """
+    def __init__(self, backend: JobBackend, max_pending: int=16, max_finished: int=256):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.jobs: dict[str, RenderJob] = {}
+        self.jobs_by_key: dict[str, RenderJob] = {}
+        # The finished jobs by id, oldest first
+        self.finished: OrderedDict[str, RenderJob] = OrderedDict()
+
+    @staticmethod
+    def key(script: Script) -> str:
+        content = json.dumps({
+            "script": json.loads(script.json()),
+            "voice": VOICE_NAME,
+            "params": RENDER_PARAMS,
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def submit(self, script: Script) -> tuple[RenderJob, bool]:
+        """Queue a render of `script`, returning its job and whether an existing one was reused."""
+        if not SCRIPT_NAME_PATTERN.fullmatch(script.name):
+            raise HTTPException(
+                status_code=422, 
+                detail="Script names can only hold letters, digits, spaces, dots, dashes and underscores, and can't start with a dot"
+            )
+        key = self.key(script)
+        existing = self.jobs_by_key.get(key)
+        if existing and existing.status != "failed":
+            return existing, True
+
+        if sum(not job.finished for job in self.jobs.values()) >= self.max_pending:
+            raise HTTPException(status_code=503, detail="Too many renders queued, try again later")
+
+        job = RenderJob(id=uuid4().hex, key=key, script_name=script.name)
+        self.jobs[job.id] = job
+        self.jobs_by_key[key] = job
+        loop = asyncio.get_running_loop()
+
+        def progress(step: str, details: dict[str, Any]):
+            loop.call_soon_threadsafe(self._record, job, "rendering", {"step": step, **details})
+
+        def finished(future: Future):
+            if future.cancelled():
+                loop.call_soon_threadsafe(self._record, job, "failed", {"step": "cancelled"})
+            elif future.exception():
+                loop.call_soon_threadsafe(self._fail, job, future.exception())
+            else:
+                loop.call_soon_threadsafe(self._complete, job, future.result())
+
+        self.backend.submit(key, script, progress).add_done_callback(finished)
+        return job, False
+
+    def _record(self, job: RenderJob, status: str, event: dict[str, Any]):
+        job.status = status
+        job.events.append(event)
+        job.changed.set()
+        job.changed = asyncio.Event()
+        if job.finished:
+            self._forget_old(job)
+
+    def _forget_old(self, job: RenderJob):
+        self.finished[job.id] = job
+        self.finished.move_to_end(job.id)
+        while len(self.finished) > self.max_finished:
+            _, old = self.finished.popitem(last=False)
+            self.jobs.pop(old.id, None)
+            if self.jobs_by_key.get(old.key) is old:
+                del self.jobs_by_key[old.key]
+
+    def _complete(self, job: RenderJob, audio_dir: Path):
+        job.audio_dir = audio_dir
+        self._record(job, "done", {"step": "done"})
+
+    def _fail(self, job: RenderJob, error: BaseException):
+        logger.error(f"Render {job.id} of {job.script_name} failed", exc_info=error)
+        job.error = str(error)
+        self._record(job, "failed", {"step": "failed", "error": job.error})
+
+    def get(self, job_id: str) -> RenderJob:
+        job = self.jobs.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail=f"Render not found: {job_id}")
+        return job
+
+    async def events(self, job: RenderJob) -> AsyncIterator[dict[str, Any]]:
+        """Every event of `job` so far, then new ones as they arrive until it finishes."""
+        sent = 0
+        while True:
+            changed = job.changed
+            while sent < len(job.events):
+                yield job.events[sent]
+                sent += 1
+            if job.finished:
+                return
+            await changed.wait()
+
+
+def parse_range(header: str, size: int) -> tuple[int, int]:
+    """The first and last byte of a single `Range` header, raising a 416 when it can't be served."""
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if not match or match.groups() == ("", ""):
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    first, last = match.groups()
+    if not first:
+        # A suffix range, the last `last` bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def read_file(path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as audio_file:
+        await audio_file.seek(start)
+        while length > 0:
+            chunk = await audio_file.read(min(CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def create_app(backend: Optional[JobBackend]=None, max_pending: int=16, max_finished: int=256) -> FastAPI:
+    """The render service: POST a script to /renders, follow its events, then fetch its audio."""
+    app = FastAPI(title="Render service")
+    queue = RenderQueue(backend or LocalJobBackend(), max_pending, max_finished)
+    app.state.queue = queue
+
+    @app.on_event("shutdown")
+    def shutdown():
+        queue.backend.shutdown()
+
+    @app.post("/renders", status_code=202)
+    async def submit_render(script: Script) -> dict[str, Any]:
+        job, coalesced = queue.submit(script)
+        return {**job.describe(), "coalesced": coalesced}
+
+    @app.get("/renders/{job_id}")
+    async def get_render(job_id: str) -> dict[str, Any]:
+        return queue.get(job_id).describe()
+
+    @app.get("/renders/{job_id}/events")
+    async def render_events(job_id: str) -> StreamingResponse:
+        """Progress of the render as server-sent events, ending once it's done or failed."""
+        job = queue.get(job_id)
+
+        async def stream() -> AsyncIterator[str]:
+            async for event in queue.events(job):
+                yield f"event: {event['step']}\ndata: {json.dumps(event)}\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @app.get("/renders/{job_id}/audio")
+    async def render_audio(job_id: str, request: Request) -> Response:
+        """The rendered WAV, supporting single byte range requests so players can seek."""
+        job = queue.get(job_id)
+        if job.status != "done" or not job.audio_dir:
+            raise HTTPException(status_code=409, detail=f"Render is {job.status}")
+        path = job.audio_dir / "output.wav"
+        size = (await aiofiles.os.stat(path)).st_size
+        headers = {"Accept-Ranges": "bytes", "Content-Type": "audio/wav"}
+
+        range_header = request.headers.get("range")
+        if range_header is None:
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(read_file(path, 0, size), headers=headers)
+        start, end = parse_range(range_header, size)
+        headers["Content-Length"] = str(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return StreamingResponse(read_file(path, start, end - start + 1), status_code=206, headers=headers)
+
+    return app
@@ -0,0 +1,189 @@
+"""Simplex noise over whole coordinate arrays.
+
+A NumPy port of the single octave `snoise2` and `snoise3` from the `noise` package's C
+extension, using its permutation table and gradients so the output matches it within
+float rounding.  Scalar noise costs a Python call per point, these evaluate every point
+of a frame in a handful of array operations.
+
+Like the C code, the coordinates are rounded to float32 and the simplex cell and the
+offsets from its corners are found in float32 whatever the dtype, since at coordinates
+in the hundreds that rounding alone changes the noise by more than 1e-4.  The dtype
+only decides what the falloff and gradients of each corner are summed in.
+"""
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+# The C extension's table, which differs from the one in `noise.perlin` at index 180
+PERM = np.tile(np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225, 140, 36, 103,
+    30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247, 120, 234, 75, 0, 26, 197,
+    62, 94, 252, 219, 203, 117, 35, 11, 32, 57, 177, 33, 88, 237, 149, 56, 87, 174, 20,
+    125, 136, 171, 168, 68, 175, 74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231,
+    83, 111, 229, 122, 60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102,
+    143, 54, 65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200,
+    196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64, 52, 217, 226,
+    250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212, 207, 206, 59, 227, 47,
+    16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213, 119, 248, 152, 2, 44, 154, 163,
+    70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22, 39, 253, 19, 98, 108, 110, 79,
+    113, 224, 232, 178, 185, 112, 104, 218, 246, 97, 228, 251, 34, 242, 193, 238, 210,
+    144, 12, 191, 179, 162, 241, 81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31,
+    181, 199, 106, 157, 184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236,
+    205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180
+], dtype=np.intp), 2)
+GRAD3 = np.array([
+    (1, 1, 0), (-1, 1, 0), (1, -1, 0), (-1, -1, 0),
+    (1, 0, 1), (-1, 0, 1), (1, 0, -1), (-1, 0, -1),
+    (0, 1, 1), (0, -1, 1), (0, 1, -1), (0, -1, -1),
+], dtype=np.float64)
+
+F2 = 0.5 * (np.sqrt(3.0) - 1.0)
+G2 = (3.0 - np.sqrt(3.0)) / 6.0
+F3 = 1.0 / 3.0
+G3 = 1.0 / 6.0
+
+
+def _snoise2(x: npt.NDArray, y: npt.NDArray, out: npt.NDArray):
+    dtype = out.dtype.type
+    grad = GRAD3.astype(dtype)
+    x = x.astype(np.float32, copy=False)
+    y = y.astype(np.float32, copy=False)
+    # Skew the input space to find the simplex cell the point is in
+    s = (x + y) * np.float32(F2)
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    t = (i + j) * np.float32(G2)
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    # Offsets of the middle corner, the lower or upper triangle of the cell
+    i1 = x0 > y0
+    j1 = ~i1
+    I = i.astype(np.intp) & 255
+    J = j.astype(np.intp) & 255
+
+    out[...] = 0
+    corners = (
+        (x0, y0, 0, 0),
+        (x0 - i1 + np.float32(G2), y0 - j1 + np.float32(G2), i1, j1),
+        (x0 + np.float32(2 * G2 - 1), y0 + np.float32(2 * G2 - 1), 1, 1),
+    )
+    for dx, dy, di, dj in corners:
+        dx = dx.astype(dtype, copy=False)
+        dy = dy.astype(dtype, copy=False)
+        g = PERM[I + di + PERM[J + dj]] % 12
+        f = dtype(0.5) - dx * dx - dy * dy
+        np.maximum(f, 0, out=f)
+        f *= f
+        f *= f
+        out += f * (grad[g, 0] * dx + grad[g, 1] * dy)
+    out *= 70
+
+def _snoise3(x: npt.NDArray, y: npt.NDArray, z: npt.NDArray, out: npt.NDArray):
+    dtype = out.dtype.type
+    grad = GRAD3.astype(dtype)
+    x = x.astype(np.float32, copy=False)
+    y = y.astype(np.float32, copy=False)
+    z = z.astype(np.float32, copy=False)
+    s = (x + y + z) * np.float32(F3)
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    k = np.floor(z + s)
+    t = (i + j + k) * np.float32(G3)
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    # Offsets of the second and third corners, depending on which of the six
+    #   tetrahedrons of the cell the point is in
+    xy = x0 >= y0
+    yz = y0 >= z0
+    xz = x0 >= z0
+    o1 = (xy & (yz | xz), ~xy & yz, ~yz & ~(xy & xz))
+    o2 = (xy | (yz & xz), ~xy | yz, ~yz | (~xy & ~xz))
+    I = i.astype(np.intp) & 255
+    J = j.astype(np.intp) & 255
+    K = k.astype(np.intp) & 255
+
+    out[...] = 0
+    corners = (
+        (x0, y0, z0, (0, 0, 0)),
+        (x0 - o1[0] + np.float32(G3), y0 - o1[1] + np.float32(G3), z0 - o1[2] + np.float32(G3), o1),
+        (x0 - o2[0] + np.float32(2 * G3), y0 - o2[1] + np.float32(2 * G3), z0 - o2[2] + np.float32(2 * G3), o2),
+        (x0 + np.float32(3 * G3 - 1), y0 + np.float32(3 * G3 - 1), z0 + np.float32(3 * G3 - 1), (1, 1, 1)),
+    )
+    for dx, dy, dz, (di, dj, dk) in corners:
+        dx = dx.astype(dtype, copy=False)
+        dy = dy.astype(dtype, copy=False)
+        dz = dz.astype(dtype, copy=False)
+        g = PERM[I + di + PERM[J + dj + PERM[K + dk]]] % 12
+        f = dtype(0.6) - dx * dx - dy * dy - dz * dz
+        np.maximum(f, 0, out=f)
+        f *= f
+        f *= f
+        out += f * (grad[g, 0] * dx + grad[g, 1] * dy + grad[g, 2] * dz)
+    out *= 32
+
+def _evaluate(kernel, coords: tuple, dtype: npt.DTypeLike, chunk_size: Optional[int], out: Optional[npt.NDArray]) -> npt.NDArray:
+    coords = np.broadcast_arrays(*(np.asarray(c, dtype=dtype) for c in coords))
+    shape = coords[0].shape
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    flat_coords = [c.reshape(-1) for c in coords]
+    flat_out = out.reshape(-1)
+    # Chunks bound the size of the temporaries, which are several times the size of the output
+    step = chunk_size or max(flat_out.size, 1)
+    for start in range(0, flat_out.size, step):
+        chunk = slice(start, start + step)
+        kernel(*(c[chunk] for c in flat_coords), flat_out[chunk])
+    return out
+
+def snoise2(
+    x: npt.ArrayLike,
+    y: npt.ArrayLike,
+    dtype: npt.DTypeLike=np.float64,
+    chunk_size: Optional[int]=None,
+    out: Optional[npt.NDArray]=None,
+) -> npt.NDArray:
+    """2D simplex noise in the range [-1, 1] at every point of the broadcast `x` and `y`.
+
+    :param x: The x coordinates.
+    :param y: The y coordinates.
+    :param dtype: The float type computed in, float32 is faster and what `noise` uses internally.
+    :param chunk_size: The number of points evaluated at a time, all of them by default.
+    :param out: A contiguous array of the broadcast shape and `dtype` to write the noise into.
+    """
+    return _evaluate(_snoise2, (x, y), dtype, chunk_size, out)
+
+def snoise3(
+    x: npt.ArrayLike,
+    y: npt.ArrayLike,
+    z: npt.ArrayLike,
+    dtype: npt.DTypeLike=np.float64,
+    chunk_size: Optional[int]=None,
+    out: Optional[npt.NDArray]=None,
+) -> npt.NDArray:
+    """3D simplex noise in the range [-1, 1] at every point of the broadcast `x`, `y` and `z`.
+
+    :param x: The x coordinates.
+    :param y: The y coordinates.
+    :param z: The z coordinates.
+    :param dtype: The float type computed in, float32 is faster and what `noise` uses internally.
+    :param chunk_size: The number of points evaluated at a time, all of them by default.
+    :param out: A contiguous array of the broadcast shape and `dtype` to write the noise into.
+    """
+    return _evaluate(_snoise3, (x, y, z), dtype, chunk_size, out)
+
+def rescaled_noise_grid(
+    x: npt.ArrayLike,
+    y: npt.ArrayLike,
+    scale: float,
+    dtype: npt.DTypeLike=np.float64,
+    chunk_size: Optional[int]=None,
+) -> npt.NDArray:
+    """The array version of `backend.common.rescaled_noise`, noise in the range [0, 1]."""
+    x = np.asarray(x, dtype=dtype) * scale
+    y = np.asarray(y, dtype=dtype) * scale
+    noise = snoise2(x, y, dtype, chunk_size)
+    noise += 1
+    noise /= 2
+    return noise
@@ -0,0 +1,86 @@
+import io
+import logging
+import subprocess
+from abc import ABC, abstractmethod
+
+import numpy as np
+import numpy.typing as npt
+from pydub import AudioSegment # type: ignore
+
+from backend.audio_buffer import samples_to_segment, segment_to_samples
+
+logger = logging.getLogger(__name__)
+
+
+class TimeStretcher(ABC):
+    """Changes the tempo of speech without changing its pitch."""
+    name: str
+
+    @abstractmethod
+    def stretch(self, samples: npt.NDArray[np.float32], sample_rate: int, tempo_pct: int) -> npt.NDArray[np.float32]:
+        """Speed up (or slow down, if negative) `samples` by `tempo_pct` percent.
+
+        :param samples: A float32 array of shape (channels, samples).
+        :param sample_rate: The sample rate of `samples`.
+        :param tempo_pct: The tempo change in percent, matching SoundStretch's `-tempo` option,
+            so the output lasts `1 / (1 + tempo_pct / 100)` times as long as the input.
+
+        :return: The retimed samples with the same channel layout.
+        """
+
+
+class SoundStretchStretcher(TimeStretcher):
+    """Retimes audio by piping it through the SoundStretch command line tool.
+
+    Every call pays for a process launch plus a WAV encode and decode, so this is
+    only used when an in-process backend isn't available.
+    """
+    name = "soundstretch"
+
+    def stretch(self, samples, sample_rate, tempo_pct):
+        segment_data = samples_to_segment(samples, sample_rate).export(format="wav")
+        soundstretch_process = subprocess.Popen(
+            ["SoundStretch", "stdin", "stdout", f"-tempo={tempo_pct}", "-speech"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        processed_data, _ = soundstretch_process.communicate(input=segment_data.read())
+        return segment_to_samples(AudioSegment.from_file(io.BytesIO(processed_data)))
+
+
+class PedalboardStretcher(TimeStretcher):
+    """Retimes audio in-process with pedalboard's Rubber Band based time stretch."""
+    name = "pedalboard"
+
+    def __init__(self):
+        # Imported here so a pedalboard build without time_stretch fails at construction
+        from pedalboard import time_stretch # type: ignore
+        self.time_stretch = time_stretch
+
+    def stretch(self, samples, sample_rate, tempo_pct):
+        return self.time_stretch(
+            np.ascontiguousarray(samples, dtype=np.float32),
+            sample_rate,
+            stretch_factor=1 + tempo_pct / 100,
+        )
+
+
+STRETCHERS: dict[str, type[TimeStretcher]] = {
+    PedalboardStretcher.name: PedalboardStretcher,
+    SoundStretchStretcher.name: SoundStretchStretcher,
+}
+
+def get_stretcher(name: str="auto") -> TimeStretcher:
+    """Create the time stretch backend called `name`.
+
+    `auto` prefers the in-process pedalboard backend and falls back to SoundStretch
+    when the installed pedalboard doesn't provide a time stretch.
+    """
+    if name != "auto":
+        return STRETCHERS[name]()
+    try:
+        return PedalboardStretcher()
+    except ImportError:
+        logger.warning("pedalboard.time_stretch is unavailable, falling back to SoundStretch")
+        return SoundStretchStretcher()
@@ -0,0 +1,73 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+from backend.common import atomic_write
+from backend.process_audio import PaddedFragment, count_syllables, padding_schedule
+from backend.schemas import Script
+
+# Trimmed off the end of every retimed fragment, see `process_audio.retime_fragments`
+CLICK_TRIM_MS = 25
+
+
+@dataclass
+class SessionSchedule:
+    """The silence after every fragment of a script, planned before any audio is rendered.
+
+    Fragments are numbered across the whole script in order and the padding of all of
+    them is computed at once by `plan`, so it's known up front and the same on every run.
+    Only the padding is planned, how long each fragment's speech lasts after retiming is
+    estimated by `timeline` and only known once it's rendered.
+
+    :param fragment_counts: The number of fragments in each clause, in script order.
+    :param padding: The padding of every fragment, in script order.
+    """
+    fragment_counts: list[int]
+    padding: list[PaddedFragment]
+
+    @classmethod
+    def plan(cls, fragment_counts: list[int], extend_silence_ms: int=500, noise_scale: float=0.1) -> "SessionSchedule":
+        return cls(fragment_counts, padding_schedule(sum(fragment_counts), extend_silence_ms, noise_scale))
+
+    def clause_padding(self, first_fragment: int, fragment_count: int) -> list[PaddedFragment]:
+        return self.padding[first_fragment:first_fragment + fragment_count]
+
+    def timeline(self, script: Script, target_speech_rate: float) -> dict[str, Any]:
+        """Estimate when every fragment starts and how long the output is before rendering it.
+
+        Speech is estimated to last as long as its syllables take at `target_speech_rate`,
+        which is what retiming aims for, so fragments that are slowed down by more than the
+        retime limit or are trimmed away entirely make the actual output differ slightly.
+        """
+        texts = [fragment.text for section in script.sections for clause in section.clauses for fragment in clause.fragments]
+        syllables = np.array([count_syllables(text) for text in texts], dtype=np.float64)
+        speech_ms = np.maximum(0, syllables / target_speech_rate * 1000 - CLICK_TRIM_MS)
+        silence_ms = np.array([pad.random_silence_duration for pad in self.padding], dtype=np.float64)
+        ends = np.cumsum(speech_ms + silence_ms)
+        starts = ends - speech_ms - silence_ms
+        return {
+            "duration_ms": float(ends[-1]) if len(ends) else 0.0,
+            "fragments": [
+                {"start_ms": start, "speech_ms": speech, "silence_ms": silence, "noise_factor": pad.noise_factor}
+                for start, speech, silence, pad in zip(starts.tolist(), speech_ms.tolist(), silence_ms.tolist(), self.padding)
+            ],
+        }
+
+    def save(self, path: Path, script: Script, target_speech_rate: float, rendered_ms: Optional[dict[int, float]]=None):
+        """Write the schedule with its estimated timeline as JSON, for tools working alongside the render.
+
+        :param rendered_ms: The rendered length of each fragment by its index in the script,
+            once the script is rendered, to record how far the estimate was off.  Fragments
+            missing from it were dropped by the trim stage.
+        """
+        schedule = {"fragment_counts": self.fragment_counts, **self.timeline(script, target_speech_rate)}
+        if rendered_ms is not None:
+            actual_ms = sum(rendered_ms.values())
+            schedule["actual_duration_ms"] = actual_ms
+            schedule["estimate_error_pct"] = (schedule["duration_ms"] - actual_ms) / actual_ms * 100 if actual_ms else 0.0
+            for ix, fragment in enumerate(schedule["fragments"]):
+                fragment["actual_ms"] = rendered_ms.get(ix, 0.0)
+        atomic_write(path, json.dumps(schedule, indent=2).encode("utf-8"))